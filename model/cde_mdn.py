@@ -1,3 +1,4 @@
+import copy
 import torch
 import torch.nn as nn
 
@@ -5,6 +6,8 @@ import model.utils as utils
 
 import torchcde
 import model.mdn as mdn
+from model.mdn import mixture_log_prob, mixture_sample
+from model.mdn_full import mixture_log_prob as mixture_log_prob_full, mixture_sample as mixture_sample_full
 # Uncomment the following line and set full_cov to True to use full covariance MDN.
 # import model.mdn_full as mdn
 
@@ -54,6 +57,10 @@ class CDE_MDN(nn.Module):
             dataparallel (bool, optional): whether to use dataparallel. Defaults to False.
             full_cov (bool, optional): whether to use full covariance MDN. Defaults to False.
 
+    Forward args:
+            coeffs (tensor): Hermite cubic coefficients of the input path.
+            lengths (tensor, optional): true lengths of the padded input sequences. If given, each sample ends its integration at its own last grid point instead of the end of the batch. Defaults to None.
+
     Returns:
             pi (tensor): predicted mixture weights.
             normal (tensor): predicted Gaussians. If dataparallel is True, this is split into loc, scale.
@@ -82,22 +89,39 @@ class CDE_MDN(nn.Module):
         self.mdn = mdn.MixtureDensityNetwork(1024, output_dim, self.n_gaussian, full_cov=full_cov)
         # utils.init_network_weights(self.cde_func, nn.init.orthogonal_)
         
-    def forward(self, coeffs):
+    def forward(self, coeffs, lengths=None):
         X = torchcde.CubicSpline(coeffs)
 
         X0 = X.evaluate(X.interval[0])
         z0 = self.initial(X0)
 
-        z_T = torchcde.cdeint(X=X,
-                              z0=z0,
-                              func=self.cde_func,
-                              t=X.interval,
-                              adjoint=False,
-                              method="dopri5", rtol=1e-3, atol=1e-5)
-        # changing (rtol, atol) from (1e-5, 1e-7) to (1e-3, 1e-5) can speed up 4x with indistinguishable performance
+        if lengths is None:
+            t = X.interval
+        else:
+            # only output at the distinct end times present in the batch
+            t_end = X.grid_points[lengths.to(X.grid_points.device) - 1]
+            t, index = torch.unique(torch.cat([X.interval[[0]], t_end]), sorted=True, return_inverse=True)
+            index = index[1:]
+
+        z_T = self._integrate(X, z0, t)
+
+        if lengths is None:
+            z_T = z_T[:, -1]
+        else:
+            z_T = z_T[torch.arange(len(z_T), device=z_T.device), index]
 
-        z_T = z_T[:, -1]
+        return self._head(z_T)
 
+    def _integrate(self, X, z0, t):
+        return torchcde.cdeint(X=X,
+                               z0=z0,
+                               func=self.cde_func,
+                               t=t,
+                               adjoint=False,
+                               method="dopri5", rtol=1e-3, atol=1e-5)
+        # changing (rtol, atol) from (1e-5, 1e-7) to (1e-3, 1e-5) can speed up 4x with indistinguishable performance
+
+    def _head(self, z_T):
         if self.output_feature:
             return z_T
 
@@ -108,6 +132,98 @@ class CDE_MDN(nn.Module):
             return pi.probs, normal.loc, normal.scale
         
         return pi, normal
+
+    def trajectory(self, coeffs, t=None):
+        """Posterior at a sequence of times along the light curves, from a single CDE solve.
+
+        The latent state is output at every requested time of the same `cdeint` call, and the
+        readout/MDN is applied to each of them, which shows how the posterior tightens as data accumulates.
+
+        Args:
+            coeffs (tensor): Hermite cubic coefficients of the input path.
+            t (tensor, optional): increasing output times within the interval of the spline. Defaults to None, i.e. all grid points.
+
+        Returns:
+            pi (nn.distributions.OneHotCategorical): mixture weights, batch shape (batch, n_times).
+            normal (nn.distributions.Normal): Gaussians, batch shape (batch, n_times, n_gaussian). If dataparallel is True, this is split into loc, scale.
+        """
+        X = torchcde.CubicSpline(coeffs)
+        if t is None:
+            t = X.grid_points
+        t = t.to(X.interval)
+        # the solve has to start at the beginning of the light curve
+        start = int(t[0] > X.interval[0])
+        if start:
+            t = torch.cat([X.interval[[0]], t])
+
+        z0 = self.initial(X.evaluate(X.interval[0]))
+        z_t = self._integrate(X, z0, t)[:, start:]
+        batch, n_times = z_t.shape[:2]
+        if self.output_feature:
+            return z_t
+
+        z_t = self.readout(z_t.reshape(batch * n_times, -1))
+        pi, normal = self.mdn(z_t)
+        pi = type(pi)(logits=pi.logits.reshape(batch, n_times, -1))
+        if isinstance(normal, torch.distributions.MultivariateNormal):
+            normal = type(normal)(normal.loc.reshape(batch, n_times, *normal.loc.shape[1:]),
+                                  scale_tril=normal.scale_tril.reshape(batch, n_times, *normal.scale_tril.shape[1:]))
+        else:
+            normal = type(normal)(normal.loc.reshape(batch, n_times, *normal.loc.shape[1:]),
+                                  normal.scale.reshape(batch, n_times, *normal.scale.shape[1:]))
+
+        if self.dataparallel:
+            return pi.probs, normal.loc, normal.scale
+
+        return pi, normal
+
+    def init_state(self, x):
+        """Run the estimator on the observed part of a path and cache what is needed to continue it.
+
+        The path is the same input that is passed to `torchcde.hermite_cubic_coefficients_with_backward_differences`
+        before calling `forward`, e.g. the logsignature sequence computed with a fixed window length.
+
+        Args:
+            x (tensor): observed path, shape (batch, length, input_dim), with length >= 2.
+
+        Returns:
+            pi (nn.distributions.OneHotCategorical): mixture weights.
+            normal (nn.distributions.Normal): Gaussians.
+            state (dict): latent state 'z' at the last observed time 't', and the last two points 'tail' of the path.
+        """
+        coeffs = torchcde.hermite_cubic_coefficients_with_backward_differences(x)
+        X = torchcde.CubicSpline(coeffs)
+        z0 = self.initial(X.evaluate(X.interval[0]))
+        z_T = self._integrate(X, z0, X.interval)[:, -1]
+        state = {'z': z_T, 'tail': x[:, -2:], 't': X.interval[-1]}
+        pi, normal = self._head(z_T)
+        return pi, normal, state
+
+    def update_state(self, state, x_new):
+        """Continue the latent state over newly observed points of the path and update the posterior.
+
+        Only the new segment is integrated, so the cost scales with the new data. The Hermite spline
+        with backward differences on a segment only depends on the previous point, so prepending the
+        cached tail makes the spline identical to the one built on the full history.
+
+        Args:
+            state (dict): state returned by `init_state` or a previous `update_state`.
+            x_new (tensor): new points of the path, shape (batch, n_new, input_dim).
+
+        Returns:
+            pi (nn.distributions.OneHotCategorical): mixture weights.
+            normal (nn.distributions.Normal): Gaussians.
+            state (dict): the updated state.
+        """
+        path = torch.cat([state['tail'], x_new], dim=1)
+        t = state['t'] - 1 + torch.arange(path.shape[1], dtype=path.dtype, device=path.device)
+        # the first segment only provides the backward difference at the old end point
+        coeffs = torchcde.hermite_cubic_coefficients_with_backward_differences(path, t=t)[:, 1:]
+        X = torchcde.CubicSpline(coeffs, t=t[1:])
+        z_T = self._integrate(X, state['z'], X.interval)[:, -1]
+        state = {'z': z_T, 'tail': path[:, -2:], 't': X.interval[-1]}
+        pi, normal = self._head(z_T)
+        return pi, normal, state
     
     def mdn_loss(self, pi, normal, y):
         """Calculate MDN loss function.
@@ -120,9 +236,10 @@ class CDE_MDN(nn.Module):
         Returns:
             loss (tensor): loss averaged on a batch of data.
         """
-        loglik = normal.log_prob(y.unsqueeze(1).expand_as(normal.loc))
-        loglik = torch.sum(loglik, dim=2)
-        loss = -torch.logsumexp(torch.log(pi.probs) + loglik, dim=1)
+        if isinstance(normal, torch.distributions.MultivariateNormal):
+            loss = -mixture_log_prob_full(pi.logits, normal.loc, normal.scale_tril, y)
+        else:
+            loss = -mixture_log_prob(pi.logits, normal.loc, normal.scale, y)
         return loss.mean()
 
     def sample(self, pi, normal):
@@ -135,5 +252,80 @@ class CDE_MDN(nn.Module):
         Returns:
             samples (tensor): one sample for each light curve.
         """
-        samples = torch.sum(pi.sample().unsqueeze(2) * normal.sample(), dim=1)
-        return samples
\ No newline at end of file
+        if isinstance(normal, torch.distributions.MultivariateNormal):
+            return mixture_sample_full(pi.logits, normal.loc, normal.scale_tril)
+        return mixture_sample(pi.logits, normal.loc, normal.scale)
+
+def quantize_estimator(model):
+    """Dynamically quantize the linear layers of an estimator to int8 for CPU inference.
+
+    Args:
+        model (CDE_MDN): the float estimator.
+
+    Returns:
+        model (CDE_MDN): a quantized copy of the estimator on CPU.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def save_quantized_estimator(model, args, path):
+    """Save a quantized estimator in the same checkpoint format as train_cde_mdn.py.
+
+    Args:
+        model (CDE_MDN): the quantized estimator.
+        args (argparse.Namespace): args of the float checkpoint.
+        path (str): path of the checkpoint.
+    """
+    torch.save({
+        'args': args,
+        'state_dict': model.state_dict(),
+        'quantized': True,
+        'input_dim': model.input_dim,
+        'output_dim': model.output_dim,
+        'full_cov': model.full_cov,
+    }, path)
+
+def load_quantized_estimator(path):
+    """Load an estimator saved with save_quantized_estimator.
+
+    Args:
+        path (str): path of the checkpoint.
+
+    Returns:
+        model (CDE_MDN): the quantized estimator on CPU, in eval mode.
+    """
+    checkpt = torch.load(path, map_location='cpu')
+    ckpt_args = checkpt['args']
+    model = CDE_MDN(checkpt['input_dim'], ckpt_args.latents, checkpt['output_dim'], ckpt_args.ngaussians, full_cov=checkpt['full_cov'])
+    model = quantize_estimator(model)
+    model.load_state_dict(checkpt['state_dict'])
+    return model
+
+def load_estimator(path, input_dim, output_dim, device='cpu', full_cov=False):
+    """Load an estimator checkpoint saved by train_cde_mdn.py or save_quantized_estimator.
+
+    Args:
+        path (str): path of the checkpoint.
+        input_dim (int): dimension of the input.
+        output_dim (int): dimension of the output.
+        device (str, optional): torch device, ignored for quantized checkpoints which run on CPU. Defaults to 'cpu'.
+        full_cov (bool, optional): whether to use full covariance MDN. Defaults to False.
+
+    Returns:
+        model (CDE_MDN): the estimator in eval mode.
+    """
+    checkpt = torch.load(path, map_location='cpu')
+    if checkpt.get('quantized', False):
+        return load_quantized_estimator(path)
+    ckpt_args = checkpt['args']
+    state_dict = checkpt['state_dict']
+
+    model = CDE_MDN(input_dim, ckpt_args.latents, output_dim, ckpt_args.ngaussians, full_cov=full_cov)
+    model_dict = model.state_dict()
+    # 1. filter out unnecessary keys
+    state_dict = {k: v for k, v in state_dict.items() if k in model_dict}
+    # 2. overwrite entries in the existing state dict
+    model_dict.update(state_dict)
+    # 3. load the new state dict
+    model.load_state_dict(model_dict)
+    return model.to(device).eval()
@@ -0,0 +1,178 @@
+import numpy as np
+import torch
+
+from model.preprocess import length_buckets, trim_to_bucket
+
+
+def extract_embeddings(model, coeffs, path, batch_size=1024, device='cpu', lengths=None):
+    """Extract the latent z_T of CDE_MDN for a dataset into a memory-mapped .npy file.
+
+    Args:
+        model (CDE_MDN): the estimator.
+        coeffs (tensor): Hermite cubic coefficients of the logsignature sequences.
+        path (str): path of the .npy file to write.
+        batch_size (int, optional): batch size. Defaults to 1024.
+        device (str, optional): torch device. Defaults to 'cpu'.
+        lengths (tensor, optional): true lengths of the padded sequences, used to batch sequences of similar lengths. Defaults to None.
+
+    Returns:
+        embeddings (np.memmap): latent vectors, shape (n_light_curves, latent_dim).
+    """
+    embeddings = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(len(coeffs), model.latent_dim))
+    if lengths is None:
+        batches = list(torch.split(torch.arange(len(coeffs)), batch_size))
+    else:
+        batches = length_buckets(lengths, batch_size)
+
+    output_feature = model.output_feature
+    model.eval()
+    model.output_feature = True
+    try:
+        with torch.no_grad():
+            for index in batches:
+                batch = coeffs[index].float()
+                kwargs = {}
+                if lengths is not None:
+                    batch = trim_to_bucket(batch, lengths[index])
+                    kwargs['lengths'] = lengths[index].to(device)
+                embeddings[index.numpy()] = model(batch.to(device), **kwargs).cpu().numpy()
+    finally:
+        model.output_feature = output_feature
+    embeddings.flush()
+    return embeddings
+
+
+def _kmeans(x, n_clusters, n_iter=20, seed=0):
+    """Plain Lloyd k-means in NumPy, used to build the coarse quantizer of the index."""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = _squared_distances(x, centroids).argmin(axis=1)
+        for i in range(n_clusters):
+            members = x[assign == i]
+            # re-seed empty clusters with a random point
+            centroids[i] = members.mean(axis=0) if len(members) else x[rng.integers(len(x))]
+    return centroids
+
+
+def _squared_distances(query, x):
+    return np.maximum((query**2).sum(axis=1)[:, None] - 2 * query @ x.T + (x**2).sum(axis=1)[None], 0)
+
+
+class EmbeddingStore(object):
+    """Nearest-neighbour search over a memory-mapped array of latent vectors.
+
+    Search is exact by default, scanning the store in chunks. After `build_index`, search is
+    approximate with an inverted-file index: the vectors are grouped by their nearest k-means
+    centroid and only the `n_probe` groups closest to the query are scanned.
+
+    Args:
+        path (str): path of the .npy file written by `extract_embeddings`.
+        metric (str, optional): 'l2' or 'cosine'. Defaults to 'l2'.
+    """
+    def __init__(self, path, metric='l2'):
+        if metric not in ['l2', 'cosine']:
+            raise ValueError(f"metric must be 'l2' or 'cosine', got {metric}")
+        self.embeddings = np.load(path, mmap_mode='r')
+        self.metric = metric
+        self.centroids = None
+        self.order = None
+        self.offsets = None
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def _prepare(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        if self.metric == 'cosine':
+            x = x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+        return x
+
+    def build_index(self, n_lists=None, n_iter=20, sample_size=100000, chunk_size=65536, seed=0):
+        """Build the inverted-file index.
+
+        Args:
+            n_lists (int, optional): number of k-means centroids. Defaults to None, i.e. about 4 sqrt(n).
+            n_iter (int, optional): number of k-means iterations. Defaults to 20.
+            sample_size (int, optional): number of vectors used to train k-means. Defaults to 100000.
+            chunk_size (int, optional): number of vectors assigned at once. Defaults to 65536.
+            seed (int, optional): random seed. Defaults to 0.
+        """
+        n = len(self)
+        if n_lists is None:
+            n_lists = max(int(4 * np.sqrt(n)), 1)
+        n_lists = min(n_lists, n)
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(n, min(sample_size, n), replace=False))
+        self.centroids = _kmeans(self._prepare(self.embeddings[sample]), n_lists, n_iter, seed)
+
+        assign = np.empty(n, dtype=np.int64)
+        for i in range(0, n, chunk_size):
+            x = self._prepare(self.embeddings[i:i+chunk_size])
+            assign[i:i+chunk_size] = _squared_distances(x, self.centroids).argmin(axis=1)
+        self.order = np.argsort(assign, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_lists))])
+
+    def save_index(self, path):
+        np.savez(path, centroids=self.centroids, order=self.order, offsets=self.offsets, metric=self.metric)
+
+    def load_index(self, path):
+        index = np.load(path)
+        if str(index['metric']) != self.metric:
+            raise ValueError(f"index was built with metric {index['metric']}, store uses {self.metric}")
+        self.centroids, self.order, self.offsets = index['centroids'], index['order'], index['offsets']
+
+    def search(self, query, k=10, n_probe=None, chunk_size=65536):
+        """Find the k nearest stored vectors of each query.
+
+        Args:
+            query (array): query vectors, shape (n_queries, latent_dim) or (latent_dim,).
+            k (int, optional): number of neighbours. Defaults to 10.
+            n_probe (int, optional): number of inverted lists scanned per query. Defaults to None, i.e. exact search.
+            chunk_size (int, optional): number of vectors scanned at once in exact search. Defaults to 65536.
+
+        Returns:
+            distances (array): squared L2 distances (or 1 - cosine similarity), shape (n_queries, k), in increasing order.
+            indices (array): indices of the neighbours in the store, shape (n_queries, k).
+        """
+        query = self._prepare(np.atleast_2d(query))
+        k = min(k, len(self))
+        if n_probe is None:
+            distances, indices = self._exact(query, k, chunk_size)
+        else:
+            if self.centroids is None:
+                raise RuntimeError('call build_index or load_index before an approximate search')
+            distances, indices = self._probe(query, k, n_probe)
+        if self.metric == 'cosine':
+            distances = distances / 2
+        return distances, indices
+
+    def _exact(self, query, k, chunk_size):
+        distances = np.full((len(query), 0), np.inf, dtype=np.float32)
+        indices = np.zeros((len(query), 0), dtype=np.int64)
+        for i in range(0, len(self), chunk_size):
+            d = _squared_distances(query, self._prepare(self.embeddings[i:i+chunk_size]))
+            distances = np.concatenate([distances, d], axis=1)
+            indices = np.concatenate([indices, np.broadcast_to(np.arange(i, i + d.shape[1]), d.shape)], axis=1)
+            # keep only the running top k
+            if distances.shape[1] > k:
+                top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+                distances = np.take_along_axis(distances, top, axis=1)
+                indices = np.take_along_axis(indices, top, axis=1)
+        order = np.argsort(distances, axis=1, kind='stable')
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+    def _probe(self, query, k, n_probe):
+        n_probe = min(n_probe, len(self.centroids))
+        lists = np.argsort(_squared_distances(query, self.centroids), axis=1)[:, :n_probe]
+        distances = np.full((len(query), k), np.inf, dtype=np.float32)
+        indices = np.full((len(query), k), -1, dtype=np.int64)
+        for q, probe in enumerate(lists):
+            candidates = np.sort(np.concatenate([self.order[self.offsets[l]:self.offsets[l+1]] for l in probe]))
+            if len(candidates) == 0:
+                continue
+            d = _squared_distances(query[[q]], self._prepare(self.embeddings[candidates]))[0]
+            top = np.argsort(d, kind='stable')[:k]
+            distances[q, :len(top)] = d[top]
+            indices[q, :len(top)] = candidates[top]
+        return distances, indices
@@ -0,0 +1,56 @@
+import sys
+import numpy as np
+
+
+def get_fsfb(amp, flux, ferr, mask=None):
+    """Compute the source flux and background flux from the computed magnification and the observed flux.
+
+    The weighted linear fit flux = fs * amp + fb is solved in closed form for any number of models at once.
+    Works on NumPy arrays and torch tensors alike.
+
+    Models for which fs and fb are undetermined, e.g. a constant magnification or fewer than two valid points,
+    get chi2 = inf and NaN fluxes instead of raising numpy.linalg.LinAlgError as the former matrix inversion did,
+    so that one degenerate model does not fail a whole batch. Check np.isfinite(chi2) where it matters.
+
+    Args:
+        amp (array or tensor): computed magnification, shape (..., n_points).
+        flux (array or tensor): observed flux, broadcastable to amp.
+        ferr (array or tensor): observed flux uncertainties, broadcastable to amp.
+        mask (array or tensor, optional): boolean mask of the valid points, broadcastable to amp, e.g. for
+            padded light curves of different lengths. Defaults to None, i.e. all points are valid.
+
+    Returns:
+        chi2 (float or array): chi2 value, shape (...).
+        fs (float or array): source flux.
+        fb (float or array): background flux.
+        fserr (float or array): source flux uncertainty.
+        fberr (float or array): background flux uncertainty.
+    """
+    # torch is only looked up if already imported, so NumPy callers do not pay for it
+    torch = sys.modules.get('torch')
+    xp = torch if torch is not None and isinstance(amp, torch.Tensor) else np
+    w = 1. / ferr**2
+    if mask is not None:
+        # padded points may hold anything, including NaN
+        w = xp.where(mask, w, xp.zeros_like(w))
+        amp = xp.where(mask, amp, xp.zeros_like(amp))
+        flux = xp.where(mask, flux, xp.zeros_like(flux))
+    s = (w * xp.ones_like(amp)).sum(-1)
+    sa = (w * amp).sum(-1)
+    saa = (w * amp**2).sum(-1)
+    sf = (w * flux).sum(-1)
+    saf = (w * amp * flux).sum(-1)
+    det = saa*s - sa**2
+    # det >= 0, and it only vanishes up to rounding errors when amp is constant over the valid points
+    degenerate = ~(det > 1e-12 * saa * s)
+    det = xp.where(degenerate, xp.ones_like(det), det)
+    fs = (s*saf - sa*sf) / det
+    fb = (saa*sf - sa*saf) / det
+    fserr = xp.sqrt(s / det)
+    fberr = xp.sqrt(saa / det)
+    chi2 = (w * (flux - fs[..., None]*amp - fb[..., None])**2).sum(-1)
+    # [()] turns the 0-d arrays of a single model back into scalars
+    nan = xp.full_like(fs, float('nan'))
+    fs, fb, fserr, fberr = (xp.where(degenerate, nan, x)[()] for x in (fs, fb, fserr, fberr))
+    chi2 = xp.where(degenerate, xp.full_like(chi2, float('inf')), chi2)[()]
+    return chi2,fs,fb,fserr,fberr
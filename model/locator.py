@@ -1,3 +1,4 @@
+import copy
 import torch
 import torch.nn as nn
 from torchvision import ops
@@ -50,41 +51,27 @@ class Locator(nn.Module):
         self.soft_threshold = soft_threshold
         self.plot = plot
        
-    def forward(self, coeffs, y, interval=None):
-        X = torchcde.CubicSpline(coeffs)
+    def _evaluate(self, X, interval):
+        if interval.dim() == 1:
+            return X.evaluate(interval)
+        # one grid per light curve: X.evaluate would evaluate every light curve on every grid, i.e. a
+        # (batch, batch, n_intervals, channel) tensor of which only the diagonal is used, so the pieces
+        # of each spline are gathered at its own grid instead, following CubicSpline.evaluate
+        fractional_part, index = X._interpret_t(interval)
+        fractional_part = fractional_part.unsqueeze(-1)
+        index = index.unsqueeze(-1).expand(-1, -1, X._b.size(-1))
+        a, b, two_c, three_d = (coeff.gather(-2, index) for coeff in (X._a, X._b, X._two_c, X._three_d))
+        inner = 0.5 * two_c + three_d * fractional_part / 3
+        inner = b + inner * fractional_part
+        return a + inner * fractional_part
 
-        if interval is None:
-            interval = torch.linspace(X.interval[0], X.interval[-1], self.n_intervals).to(self.device)
-        else:
-            interval = interval.to(self.device)
-
-        z = X.evaluate(interval)
-        if len(z.shape) > 3:
-            z = torch.diagonal(z, dim1=0, dim2=1).permute(2, 0, 1)
-        z0 = z[:, :, [1]]
+    def _segment(self, z0):
         z = z0.transpose(-1, -2) # (batch, time, channel) -> (batch, channel, time)
         z = self.prefilter(z) + z
         z = self.unet(z)
-        z = z.squeeze(-2)
-
-        left = y[:, [0]] - y[:, [1]] * self.k
-        right = y[:, [0]] + y[:, [1]] * self.k
-        zt = X.evaluate(interval)
-        if len(zt.shape) > 3:
-            zt = torch.diagonal(zt, dim1=0, dim2=1).permute(2, 0, 1)
-        zt = zt[:, :, 0]
-        zt = ((zt > left) * (zt < right)).int().float()
-
-        cross_entropy = -torch.mean(zt*torch.log(z+1e-10)+(1-zt)*torch.log(1-z+1e-10))
-        dice_loss = self.loss(z, zt)
-        # mse_z = (self.loss(z, zt)-torch.mean(zt*torch.log(z+1e-10)+(1-zt)*torch.log(1-z+1e-10)))/2
-
-
-        timelist = X.evaluate(interval)
-        if len(timelist.shape) > 3:
-            timelist = torch.diagonal(timelist, dim1=0, dim2=1).permute(2, 0, 1)
-        timelist = timelist[:, :, 0]
+        return z.squeeze(-2)
 
+    def _regress(self, z, timelist):
         if not self.soft_threshold:
             z = (z > self.threshold).int()
         diffz = torch.diff(z, append=z[:, [-1]])
@@ -99,7 +86,31 @@ class Locator(nn.Module):
             reg = torch.hstack([avg, area / (2 * self.k)])
         else:
             print('method can only be diff or avg')
-            
+        return reg, z, diffz
+
+    def forward(self, coeffs, y, interval=None):
+        X = torchcde.CubicSpline(coeffs)
+
+        if interval is None:
+            interval = torch.linspace(X.interval[0], X.interval[-1], self.n_intervals).to(self.device)
+        else:
+            interval = interval.to(self.device)
+
+        # the spline is evaluated only once, time and flux are both read from it
+        x = self._evaluate(X, interval)
+        timelist = x[:, :, 0]
+        z0 = x[:, :, [1]]
+        z = self._segment(z0)
+
+        left = y[:, [0]] - y[:, [1]] * self.k
+        right = y[:, [0]] + y[:, [1]] * self.k
+        zt = ((timelist > left) * (timelist < right)).int().float()
+
+        cross_entropy = -torch.mean(zt*torch.log(z+1e-10)+(1-zt)*torch.log(1-z+1e-10))
+        dice_loss = self.loss(z, zt)
+        # mse_z = (self.loss(z, zt)-torch.mean(zt*torch.log(z+1e-10)+(1-zt)*torch.log(1-z+1e-10)))/2
+
+        reg, z, diffz = self._regress(z, timelist)
 
         # length_penalty = torch.log(torch.mean((torch.sum(z, dim=-1) - torch.sum(zt, dim=-1))**2) + 1e-10)
         diffz_abssum_penalty = torch.mean((torch.sum(torch.abs(diffz), dim=-1) - 2.)**2)
@@ -136,4 +147,194 @@ class Locator(nn.Module):
         mask = torch.stack([timelist.detach(), z.detach()], dim=-1)
         if self.animate:
             return reg, loss_z, mask
-        return reg, loss_z
\ No newline at end of file
+        return reg, loss_z
+
+    def predict(self, coeffs, interval=None, return_mask=False, batch_size=None):
+        """Predict t_0 and t_E without targets and without computing the losses.
+
+        Args:
+            coeffs (tensor): Hermite cubic coefficients of the light curves.
+            interval (tensor, optional): time grid to evaluate the light curves on. Defaults to None, i.e. n_intervals points evenly spaced over the whole light curve.
+            return_mask (bool, optional): whether to also return the predicted mask. Defaults to False.
+            batch_size (int, optional): number of light curves passed through the U-Net at once, to bound the memory. Defaults to None, i.e. the whole batch.
+
+        Returns:
+            reg (tensor): prediction of t_0 and t_E, shape (batch, 2).
+            mask (tensor, if return_mask==True): time grid and predicted mask, shape (batch, n_intervals, 2).
+        """
+        if batch_size is None:
+            batch_size = len(coeffs)
+        reg, mask = [], []
+        with torch.no_grad():
+            for i in range(0, len(coeffs), batch_size):
+                batch = coeffs[i:i+batch_size].to(self.device)
+                X = torchcde.CubicSpline(batch)
+                if interval is None:
+                    batch_interval = torch.linspace(X.interval[0], X.interval[-1], self.n_intervals).to(self.device)
+                elif interval.dim() > 1:
+                    batch_interval = interval[i:i+batch_size].to(self.device)
+                else:
+                    batch_interval = interval.to(self.device)
+                x = self._evaluate(X, batch_interval)
+                timelist = x[:, :, 0]
+                reg_batch, z, _ = self._regress(self._segment(x[:, :, [1]]), timelist)
+                reg.append(reg_batch)
+                if return_mask:
+                    mask.append(torch.stack([timelist, z], dim=-1))
+        if return_mask:
+            return torch.cat(reg), torch.cat(mask)
+        return torch.cat(reg)
+
+class _LocatorHead(nn.Module):
+    '''
+    The prefilter and U-Net of a Locator, i.e. the part that depends on k.
+    '''
+    def __init__(self, locator):
+        super(_LocatorHead, self).__init__()
+        self.prefilter = locator.prefilter
+        self.unet = locator.unet
+
+    def forward(self, z0):
+        z = z0.transpose(-1, -2) # (batch, time, channel) -> (batch, channel, time)
+        z = self.prefilter(z) + z
+        z = self.unet(z)
+        return z.squeeze(-2)
+
+
+class LocatorEnsemble(nn.Module):
+    '''
+    An ensemble of Locators trained with different k, sharing one spline evaluation.
+
+    The light curves are evaluated on the interval grid once and fed to all the prefilter/U-Net heads.
+    If all the heads have the same architecture, their weights are stacked and evaluated in one batched
+    pass with torch.func.vmap, otherwise the heads are evaluated one after another.
+
+    Args:
+            locators (list): Locators on their target device, e.g. with k = 1/3, 0.75, 1, 1.25, 1.5, 1.75 and 2.
+            combine (str, optional): how to combine the predictions of the heads, 'median' or 'mean'. Defaults to 'median'.
+            weights (list, optional): weights of the heads when combine=='mean'. Defaults to None, i.e. equal weights.
+
+    Returns:
+            reg (tensor): combined prediction of t_0 and t_E.
+            reg_all (tensor, if return_all==True): prediction of each head, shape (n_heads, batch, 2).
+    '''
+    def __init__(self, locators, combine='median', weights=None):
+        super(LocatorEnsemble, self).__init__()
+        if combine not in ('median', 'mean'):
+            raise ValueError(f"combine can only be 'median' or 'mean', got {combine!r}")
+        self.locators = nn.ModuleList(locators)
+        self.device = locators[0].device
+        self.n_intervals = locators[0].n_intervals
+        self.combine = combine
+        if weights is None:
+            weights = torch.ones(len(locators))
+        self.register_buffer('weights', torch.as_tensor(weights, dtype=torch.float))
+        self.stacked = self._stackable()
+        # (base, params, buffers) of the stacked heads, kept out of the registered modules and rebuilt
+        # whenever the weights of the locators move or change, e.g. after .to() or load_state_dict
+        self._stacked_key = None
+        self._stacked_heads = None
+
+    @property
+    def heads(self):
+        # views of the locators, so they are neither registered twice nor stale after .to() or load_state_dict
+        return [_LocatorHead(locator) for locator in self.locators]
+
+    def _stackable(self):
+        try:
+            from torch.func import stack_module_state, functional_call, vmap
+        except ImportError:
+            return False
+        shapes = [{k: v.shape for k, v in head.state_dict().items()} for head in self.heads]
+        return all(shape == shapes[0] for shape in shapes)
+
+    def _stack(self):
+        from torch.func import stack_module_state
+        heads = self.heads
+        tensors = [t for head in heads for t in list(head.parameters()) + list(head.buffers())]
+        key = tuple((t.device, t.data_ptr(), t._version) for t in tensors)
+        if key != self._stacked_key:
+            with torch.no_grad():
+                params, buffers = stack_module_state(heads)
+            self._stacked_heads = (copy.deepcopy(heads[0]).to('meta'), params, buffers)
+            self._stacked_key = key
+        return self._stacked_heads
+
+    def _segment(self, z0):
+        if self.stacked:
+            from torch.func import functional_call, vmap
+            base, params, buffers = self._stack()
+            def segment(params, buffers, z0):
+                return functional_call(base, (params, buffers), (z0,))
+            return vmap(segment, in_dims=(0, 0, None))(params, buffers, z0)
+        return torch.stack([head(z0) for head in self.heads])
+
+    def forward(self, coeffs, interval=None):
+        return self.predict(coeffs, interval)
+
+    def predict(self, coeffs, interval=None, return_all=False, batch_size=None):
+        """Predict t_0 and t_E with all the heads.
+
+        Args:
+            coeffs (tensor): Hermite cubic coefficients of the light curves.
+            interval (tensor, optional): time grid to evaluate the light curves on. Defaults to None, i.e. n_intervals points evenly spaced over the whole light curve.
+            return_all (bool, optional): whether to also return the prediction of each head. Defaults to False.
+            batch_size (int, optional): number of light curves passed through the heads at once, to bound the memory. Defaults to None, i.e. the whole batch.
+
+        Returns:
+            reg (tensor): combined prediction of t_0 and t_E, shape (batch, 2).
+            reg_all (tensor, if return_all==True): prediction of each head, shape (n_heads, batch, 2).
+        """
+        if batch_size is None:
+            batch_size = len(coeffs)
+        reg_all = []
+        with torch.no_grad():
+            for i in range(0, len(coeffs), batch_size):
+                batch = coeffs[i:i+batch_size].to(self.device)
+                X = torchcde.CubicSpline(batch)
+                if interval is None:
+                    batch_interval = torch.linspace(X.interval[0], X.interval[-1], self.n_intervals).to(self.device)
+                elif interval.dim() > 1:
+                    batch_interval = interval[i:i+batch_size].to(self.device)
+                else:
+                    batch_interval = interval.to(self.device)
+                x = self.locators[0]._evaluate(X, batch_interval)
+                timelist = x[:, :, 0]
+                z = self._segment(x[:, :, [1]])
+                reg_all.append(torch.stack([locator._regress(z[j], timelist)[0] for j, locator in enumerate(self.locators)]))
+        reg_all = torch.cat(reg_all, dim=1)
+
+        if self.combine == 'median':
+            reg = torch.median(reg_all, dim=0).values
+        else:
+            weights = (self.weights / self.weights.sum()).to(reg_all)
+            reg = torch.sum(weights[:, None, None] * reg_all, dim=0)
+
+        if return_all:
+            return reg, reg_all
+        return reg
+
+
+def load_locator(path, device, **kwargs):
+    """Load a Locator checkpoint saved by train_locator.py.
+
+    Args:
+        path (str): path of the checkpoint.
+        device (str): torch device.
+        **kwargs: other arguments of Locator, e.g. k and method.
+
+    Returns:
+        model (Locator): the Locator in eval mode.
+    """
+    checkpt = torch.load(path, map_location='cpu')
+    state_dict = checkpt['state_dict']
+
+    model = Locator(device, **kwargs)
+    model_dict = model.state_dict()
+    # 1. filter out unnecessary keys
+    state_dict = {k: v for k, v in state_dict.items() if k in model_dict}
+    # 2. overwrite entries in the existing state dict
+    model_dict.update(state_dict)
+    # 3. load the new state dict
+    model.load_state_dict(model_dict)
+    return model.to(device).eval()
@@ -1,11 +1,33 @@
 """
 Ref: https://github.com/tonyduan/mdn/blob/master/mdn/models.py
 """
+import math
 import torch
 import torch.nn as nn
 from torch.distributions import Normal, OneHotCategorical
 
 
+def mixture_log_prob(logits, loc, scale, y):
+    """
+    Log likelihood of y under the diagonal Gaussian mixture, computed directly from the network outputs.
+
+    logits: (batch, n_components); loc, scale: (batch, n_components, dim_out); y: (batch, dim_out)
+    """
+    z = (y.unsqueeze(1) - loc) / scale
+    loglik = -0.5 * torch.sum(z**2, dim=2) - torch.sum(torch.log(scale), dim=2) - 0.5 * loc.shape[-1] * math.log(2 * math.pi)
+    return torch.logsumexp(torch.log_softmax(logits, dim=1) + loglik, dim=1)
+
+
+def mixture_sample(logits, loc, scale):
+    """
+    One sample from each diagonal Gaussian mixture, drawing only from the selected component.
+    """
+    index = torch.multinomial(torch.softmax(logits, dim=1), 1)
+    loc = torch.gather(loc, 1, index.unsqueeze(-1).expand(-1, -1, loc.shape[-1]))[:, 0]
+    scale = torch.gather(scale, 1, index.unsqueeze(-1).expand(-1, -1, scale.shape[-1]))[:, 0]
+    return loc + scale * torch.randn_like(loc)
+
+
 class MixtureDensityNetwork(nn.Module):
     """
     Mixture density network.
@@ -29,15 +51,11 @@ class MixtureDensityNetwork(nn.Module):
 
     def loss(self, x, y):
         pi, normal = self.forward(x)
-        loglik = normal.log_prob(y.unsqueeze(1).expand_as(normal.loc))
-        loglik = torch.sum(loglik, dim=2)
-        loss = -torch.logsumexp(torch.log(pi.probs) + loglik, dim=1)
-        return loss
+        return -mixture_log_prob(pi.logits, normal.loc, normal.scale, y)
 
     def sample(self, x):
         pi, normal = self.forward(x)
-        samples = torch.sum(pi.sample().unsqueeze(2) * normal.sample(), dim=1)
-        return samples
+        return mixture_sample(pi.logits, normal.loc, normal.scale)
 
 
 class MixtureDiagNormalNetwork(nn.Module):
@@ -56,9 +74,9 @@ class MixtureDiagNormalNetwork(nn.Module):
     def forward(self, x):
         params = self.network(x)
         mean, sd = torch.split(params, params.shape[1] // 2, dim=1)
-        mean = torch.stack(mean.split(mean.shape[1] // self.n_components, 1))
-        sd = torch.stack(sd.split(sd.shape[1] // self.n_components, 1))
-        return Normal(mean.transpose(0, 1), torch.exp(sd).transpose(0, 1))
+        mean = mean.reshape(mean.shape[0], self.n_components, -1)
+        sd = sd.reshape(sd.shape[0], self.n_components, -1)
+        return Normal(mean, torch.exp(sd), validate_args=False)
 
 class CategoricalNetwork(nn.Module):
 
@@ -74,4 +92,4 @@ class CategoricalNetwork(nn.Module):
 
     def forward(self, x):
         params = self.network(x)
-        return OneHotCategorical(logits=params)
\ No newline at end of file
+        return OneHotCategorical(logits=params, validate_args=False)
\ No newline at end of file
@@ -1,7 +1,31 @@
+import math
 import torch
 import torch.nn as nn
 from torch.distributions import MultivariateNormal, OneHotCategorical
 
+
+def mixture_log_prob(logits, loc, scale_tril, y):
+    """
+    Log likelihood of y under the Gaussian mixture with Cholesky factors scale_tril, computed directly from the network outputs.
+
+    logits: (batch, n_components); loc: (batch, n_components, dim_out); scale_tril: (batch, n_components, dim_out, dim_out); y: (batch, dim_out)
+    """
+    diff = (y.unsqueeze(1) - loc).unsqueeze(-1)
+    z = torch.linalg.solve_triangular(scale_tril, diff, upper=False).squeeze(-1)
+    log_det = torch.sum(torch.log(torch.diagonal(scale_tril, dim1=-2, dim2=-1)), dim=-1)
+    loglik = -0.5 * torch.sum(z**2, dim=-1) - log_det - 0.5 * loc.shape[-1] * math.log(2 * math.pi)
+    return torch.logsumexp(torch.log_softmax(logits, dim=1) + loglik, dim=1)
+
+
+def mixture_sample(logits, loc, scale_tril):
+    """
+    One sample from each Gaussian mixture, drawing only from the selected component.
+    """
+    index = torch.multinomial(torch.softmax(logits, dim=1), 1)
+    loc = torch.gather(loc, 1, index.unsqueeze(-1).expand(-1, -1, loc.shape[-1]))[:, 0]
+    scale_tril = torch.gather(scale_tril, 1, index[..., None, None].expand(-1, -1, *scale_tril.shape[-2:]))[:, 0]
+    return loc + torch.matmul(scale_tril, torch.randn_like(loc).unsqueeze(-1)).squeeze(-1)
+
 class MixtureDensityNetwork(nn.Module):
     """
     Mixture density network compatible with full covariance.
@@ -25,14 +49,11 @@ class MixtureDensityNetwork(nn.Module):
 
     def loss(self, x, y):
         pi, normal = self.forward(x)
-        loglik = normal.log_prob(y.unsqueeze(1).expand_as(normal.loc))
-        loss = -torch.logsumexp(torch.log(pi.probs) + loglik, dim=1)
-        return loss
+        return -mixture_log_prob(pi.logits, normal.loc, normal.scale_tril, y)
 
     def sample(self, x):
         pi, normal = self.forward(x)
-        samples = torch.sum(pi.sample().unsqueeze(2) * normal.sample(), dim=1)
-        return samples
+        return mixture_sample(pi.logits, normal.loc, normal.scale_tril)
 
 class NormalNetwork(nn.Module):
     def __init__(self, in_dim, out_dim, n_components, full_cov=True):
@@ -41,6 +62,8 @@ class NormalNetwork(nn.Module):
         self.out_dim = out_dim
         self.full_cov = full_cov
         self.tril_indices = torch.tril_indices(row=out_dim, col=out_dim, offset=0)
+        # positions of the diagonal elements in the packed lower triangle
+        self.tril_diag = self.tril_indices[0] == self.tril_indices[1]
         self.elu = nn.ELU()
         self.mean_net = nn.Sequential(
                 nn.Linear(in_dim, out_dim * n_components),
@@ -59,15 +82,16 @@ class NormalNetwork(nn.Module):
         mean = self.mean_net(x).reshape(-1, self.n_components, self.out_dim)
         if self.full_cov:
             tril_values = self.tril_net(x).reshape(mean.shape[0], self.n_components, -1)
-            tril = torch.zeros(mean.shape[0], mean.shape[1], mean.shape[2], mean.shape[2]).to(x.device)
-            tril[:, :, self.tril_indices[0], self.tril_indices[1]] = tril_values
             # diagonal element must be strictly positive
             # use diag = elu(diag) + 1 to ensure positivity
-            tril = tril - torch.diag_embed(torch.diagonal(tril, dim1=-2, dim2=-1)) + torch.diag_embed(self.elu(torch.diagonal(tril, dim1=-2, dim2=-1)) + 1 + 1e-8)
+            tril_diag = self.tril_diag.to(x.device)
+            tril_values = torch.where(tril_diag, self.elu(tril_values) + 1 + 1e-8, tril_values)
+            tril = tril_values.new_zeros(mean.shape[0], mean.shape[1], mean.shape[2], mean.shape[2])
+            tril[:, :, self.tril_indices[0], self.tril_indices[1]] = tril_values
         else:
             tril = self.tril_net(x).reshape(mean.shape[0], self.n_components, -1)
             tril = torch.diag_embed(self.elu(tril) + 1 + 1e-8)
-        return MultivariateNormal(mean, scale_tril=tril)
+        return MultivariateNormal(mean, scale_tril=tril, validate_args=False)
 
 class CategoricalNetwork(nn.Module):
 
@@ -79,4 +103,4 @@ class CategoricalNetwork(nn.Module):
 
     def forward(self, x):
         params = self.network(x)
-        return OneHotCategorical(logits=params)
\ No newline at end of file
+        return OneHotCategorical(logits=params, validate_args=False)
\ No newline at end of file
@@ -0,0 +1,229 @@
+import torch
+
+
+def get_lengths(X):
+    """Get the true lengths of sequences padded by repeating the last row.
+
+    The logsignature sequences produced by `test/locate_and_scale.py` and the joint notebook
+    are padded to the longest sequence with `lc[-1].expand(...)`, so the padding is the trailing
+    run of rows identical to the last one.
+
+    Args:
+        X (tensor): padded sequences, shape (n_light_curves, length, channels).
+
+    Returns:
+        lengths (tensor): number of valid rows of each sequence, shape (n_light_curves,).
+    """
+    length = X.shape[1]
+    differ = (X != X[:, [-1]]).any(dim=-1)
+    index = torch.arange(length, device=X.device).expand_as(differ)
+    last_differ = torch.where(differ, index, torch.full_like(index, -1)).max(dim=-1).values
+    # the row after the last differing one is the true end of the sequence
+    return torch.clamp(last_differ + 2, max=length)
+
+
+def length_buckets(lengths, batch_size, shuffle=False, generator=None):
+    """Group sequences of similar lengths into batches.
+
+    Sequences are sorted by length and cut into consecutive batches, so that each batch
+    only has to be integrated up to the end of its own longest member.
+
+    Args:
+        lengths (tensor): lengths of the sequences, shape (n_light_curves,).
+        batch_size (int): batch size.
+        shuffle (bool, optional): whether to shuffle the order of the batches. Defaults to False.
+        generator (torch.Generator, optional): generator used for shuffling. Defaults to None.
+
+    Returns:
+        buckets (list): list of index tensors, one for each batch.
+    """
+    lengths = torch.as_tensor(lengths)
+    order = torch.argsort(lengths, stable=True)
+    buckets = list(torch.split(order, batch_size))
+    if shuffle:
+        buckets = [buckets[i] for i in torch.randperm(len(buckets), generator=generator)]
+    return buckets
+
+
+def trim_to_bucket(coeffs, lengths):
+    """Cut the spline coefficients of a batch to the length of its longest sequence.
+
+    Args:
+        coeffs (tensor): Hermite cubic coefficients, shape (batch, length - 1, :).
+        lengths (tensor): lengths of the sequences in the batch, shape (batch,).
+
+    Returns:
+        coeffs (tensor): coefficients covering only the longest sequence of the batch.
+    """
+    max_len = max(int(lengths.max()), 2)
+    return coeffs[:, :max_len - 1]
+
+
+def _compact_window(X, tmin, tmax, lengths=None):
+    """Move the points within [tmin, tmax] to the front of each light curve, keeping their order."""
+    valid = (X[..., 0] >= tmin) * (X[..., 0] <= tmax) * ~torch.isnan(X).any(dim=-1)
+    if lengths is not None:
+        valid = valid * (torch.arange(X.shape[1]) < lengths[:, None])
+    order = torch.argsort((~valid).int(), dim=-1, stable=True)
+    X = torch.gather(X, 1, order.unsqueeze(-1).expand_as(X))
+    return X, valid.sum(dim=-1)
+
+
+def _logsig_chunk(X, n_valid, depth, n_windows):
+    """Compute the windowed logsignatures of a chunk of compacted light curves in a single call.
+
+    Equivalent to calling `torchcde.logsig_windows(lc[:n_valid], depth, window_length=max(n_valid//n_windows, 1))`
+    on each light curve: every window of every light curve is gathered into one batch, windows shorter
+    than the longest one are extended by repeating their last point, which leaves the logsignature unchanged.
+    """
+    import signatory
+
+    batch, _, channels = X.shape
+    window = torch.clamp(torch.div(n_valid, n_windows, rounding_mode='floor'), min=1)
+    n_pieces = torch.div(n_valid - 2 + window, window, rounding_mode='floor').clamp(min=0)
+    max_pieces = int(n_pieces.max()) if batch > 0 else 0
+    max_window = int(window.max()) if batch > 0 else 1
+
+    logsig_channels = signatory.logsignature_channels(channels, depth)
+    first = torch.zeros(batch, 1, logsig_channels, dtype=X.dtype)
+    first[:, 0, :channels] = X[:, 0]
+    if max_pieces == 0:
+        return first, n_pieces + 1
+
+    start = torch.arange(max_pieces) * window[:, None]
+    end = torch.minimum(start + window[:, None], (n_valid[:, None] - 1).clamp(min=0))
+    index = torch.minimum(start[..., None] + torch.arange(max_window + 1), end[..., None])
+    windows = X[torch.arange(batch)[:, None, None], index]
+    # windows past the end of a light curve are constant and have zero logsignature
+    logsig = signatory.Logsignature(depth=depth)(windows.reshape(batch * max_pieces, max_window + 1, channels))
+    logsig = torch.cat([first, logsig.view(batch, max_pieces, -1)], dim=1).cumsum(dim=1)
+    return logsig, n_pieces + 1
+
+
+def _logsig_task(args):
+    X, n_valid, depth, n_windows = args
+    try:
+        return _logsig_chunk(X, n_valid, depth, n_windows), None
+    except Exception as e:
+        return None, repr(e)
+
+
+def logsig_windows_batched(X, depth=3, tmin=-2, tmax=2, n_windows=100, chunk_size=1024, n_workers=1, lengths=None):
+    """Compute windowed logsignatures of a batch of light curves with per-sample window lengths.
+
+    For each light curve, the points within [tmin, tmax] are kept and the window length is
+    `max(n_points // n_windows, 1)`, as in `test/locate_and_scale.py`. All light curves of a chunk
+    are processed in one vectorized pass, and chunks can be spread across CPU workers.
+
+    Args:
+        X (tensor): light curves, shape (n_light_curves, length, channels), with time as the first channel.
+        depth (int, optional): depth of the logsignature. Defaults to 3.
+        tmin (float, optional): start of the time window. Defaults to -2.
+        tmax (float, optional): end of the time window. Defaults to 2.
+        n_windows (int, optional): approximate number of windows per light curve. Defaults to 100.
+        chunk_size (int, optional): number of light curves processed at once. Defaults to 1024.
+        n_workers (int, optional): number of worker processes. Defaults to 1.
+        lengths (tensor, optional): true lengths of padded light curves, shape (n_light_curves,). Defaults to None, i.e. all rows are data.
+
+    Returns:
+        logsig (tensor): logsignature sequences padded by repeating the last row, shape (n_light_curves, max_length, logsig_channels). Rows of failed light curves are NaN.
+        lengths (tensor): true lengths of the sequences, shape (n_light_curves,). Zero for failed light curves.
+        failures (list): one dict per failed light curve, with keys 'index', 'n_points' and 'reason'.
+    """
+    X, n_valid = _compact_window(X, tmin, tmax, lengths)
+    tasks = []
+    for i in range(0, len(X), chunk_size):
+        n = n_valid[i:i+chunk_size]
+        tasks.append((X[i:i+chunk_size, :max(int(n.max()), 1)], n, depth, n_windows))
+
+    if n_workers > 1:
+        from multiprocessing import Pool
+        with Pool(processes=n_workers) as pool:
+            results = pool.map(_logsig_task, tasks)
+    else:
+        results = [_logsig_task(task) for task in tasks]
+
+    channels = next((result[0].shape[-1] for result, _ in results if result is not None), X.shape[-1])
+    max_len = max([int(result[1].max()) for result, _ in results if result is not None] + [1])
+    logsig = torch.full((len(X), max_len, channels), float('nan'), dtype=X.dtype)
+    lengths = torch.zeros(len(X), dtype=torch.long)
+    failures = []
+    for i, ((result, error), (_, n, _, _)) in enumerate(zip(results, tasks)):
+        offset = i * chunk_size
+        if result is None:
+            failures += [{'index': offset + j, 'n_points': int(n[j]), 'reason': error} for j in range(len(n))]
+            continue
+        chunk, chunk_lengths = result
+        chunk = torch.cat([chunk, chunk[:, [-1]].expand(-1, max_len - chunk.shape[1], -1)], dim=1)
+        failed = (n < 2) | ~torch.isfinite(chunk).all(dim=-1).all(dim=-1)
+        for j in torch.where(failed)[0].tolist():
+            reason = f'fewer than 2 points in [{tmin}, {tmax}]' if n[j] < 2 else 'non-finite logsignature'
+            failures.append({'index': offset + j, 'n_points': int(n[j]), 'reason': reason})
+        logsig[offset:offset+len(n)][~failed] = chunk[~failed]
+        lengths[offset:offset+len(n)][~failed] = chunk_lengths[~failed]
+    return logsig, lengths, failures
+
+
+def pad_lcs(lcs):
+    """Stack light curves of different lengths, padding each one by repeating its last row.
+
+    Args:
+        lcs (list): light curves, each of shape (n_points, channels).
+
+    Returns:
+        X (tensor): padded light curves, shape (n_light_curves, max_n_points, channels).
+        lengths (tensor): number of points of each light curve, shape (n_light_curves,).
+    """
+    lcs = [torch.as_tensor(lc) for lc in lcs]
+    lengths = torch.tensor([len(lc) for lc in lcs])
+    max_len = int(lengths.max())
+    X = torch.stack([torch.cat([lc, lc[[-1]].expand(max_len - len(lc), -1)]) for lc in lcs])
+    return X, lengths
+
+
+def locator_interval(lengths, n_intervals=4000):
+    """Per light curve evaluation grid for the Locator, covering only the true points of padded light curves.
+
+    Locator evaluates each light curve on its own row of the grid, so the cost is linear in the batch size.
+
+    Args:
+        lengths (tensor): number of points of each light curve, shape (n_light_curves,).
+        n_intervals (int, optional): number of grid points. Defaults to 4000.
+
+    Returns:
+        interval (tensor): grid in the index time of the spline, shape (n_light_curves, n_intervals).
+    """
+    return torch.linspace(0, 1, n_intervals)[None] * (lengths[:, None] - 1).float()
+
+
+def rescale_lcs(X, reg, lengths=None, tmin=-2, tmax=2, mag_scale=0.2):
+    """Shift and rescale light curves with the located t_0 and t_E, as in `test/test_KMT.ipynb`.
+
+    Time becomes (t - t_0) / t_E, and magnitude becomes (mag - baseline) / mag_scale,
+    where the baseline is the mean magnitude outside [tmin, tmax]. If a light curve has
+    no points outside the window, its faintest point is used as the baseline.
+
+    Args:
+        X (tensor): light curves, shape (n_light_curves, length, channels), with time and magnitude as the first two channels.
+        reg (tensor): t_0 and t_E predicted by the Locator, shape (n_light_curves, 2).
+        lengths (tensor, optional): true lengths of padded light curves. Defaults to None, i.e. all rows are data.
+        tmin (float, optional): start of the window. Defaults to -2.
+        tmax (float, optional): end of the window. Defaults to 2.
+        mag_scale (float, optional): scale of the magnitude. Defaults to 0.2.
+
+    Returns:
+        X (tensor): rescaled light curves, shape (n_light_curves, length, 2).
+    """
+    reg = reg.to(X)
+    t = (X[..., 0] - reg[:, [0]]) / reg[:, [1]]
+    mag = X[..., 1]
+    valid = torch.ones_like(t, dtype=torch.bool)
+    if lengths is not None:
+        valid = torch.arange(X.shape[1]) < lengths[:, None]
+    outside = valid * ((t < tmin) | (t > tmax))
+    n_outside = outside.sum(dim=-1)
+    baseline = torch.sum(mag * outside, dim=-1) / n_outside.clamp(min=1)
+    faintest = torch.max(torch.where(valid, mag, torch.full_like(mag, -float('inf'))), dim=-1).values
+    baseline = torch.where(n_outside > 0, baseline, faintest)
+    mag = (mag - baseline[:, None]) / mag_scale
+    return torch.stack([t, mag], dim=-1)
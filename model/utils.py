@@ -5,11 +5,13 @@ import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
 from tqdm.notebook import tqdm
-from scipy.signal import find_peaks
 import matplotlib.pyplot as plt
 from matplotlib.offsetbox import AnchoredText
 import MulensModel as mm
 
+from model.preprocess import length_buckets, trim_to_bucket
+from model.fluxes import get_fsfb
+
 def ecdf(x):
     """Compute the empirical cumulative distribution function of a dataset.
 
@@ -31,40 +33,6 @@ def ecdf(x):
     xval = np.array(xval)
     return xval, cdf
 
-def get_fsfb(amp, flux, ferr):
-    """Compute the source flux and background flux from the computed magnification and the observed flux.
-
-    Args:
-        amp (array): computed magnification.
-        flux (array): observed flux.
-        ferr (array): observed flux uncertainties.
-
-    Returns:
-        chi2 (float): chi2 value.
-        fs (float): source flux.
-        fb (float): background flux.
-        fserr (float): source flux uncertainty.
-        fberr (float): background flux uncertainty.
-    """
-    sig2 = ferr**2
-    wght = flux/sig2
-    d = np.ones(2)
-    d[0] = np.sum(wght*amp)
-    d[1] = np.sum(wght)
-    b = np.zeros((2,2))
-    b[0,0] = np.sum(amp**2/sig2)
-    b[0,1] = np.sum(amp/sig2)
-    b[1,0] = b[0,1]
-    b[1,1] = np.sum(1./sig2)
-    c = np.linalg.inv(b)
-    fs = np.sum(c[0]*d)
-    fb = np.sum(c[1]*d)
-    fserr = np.sqrt(c[0,0])
-    fberr = np.sqrt(c[1,1])
-    fmod = fs*amp+fb
-    chi2 = np.sum((flux-fmod)**2/sig2)
-    return chi2,fs,fb,fserr,fberr
-
 def getfsfb(times, iflux, iferr, t_0, t_E, u_0, lgrho, lgq, lgs, alpha_180, **kwargs):
     """Compute the source flux and background flux from the binary microlensing parameters and the observed flux
     using MulensModel.
@@ -87,7 +55,17 @@ def getfsfb(times, iflux, iferr, t_0, t_E, u_0, lgrho, lgq, lgs, alpha_180, **kw
         fb (float): background flux.
         fserr (float): source flux uncertainty.
         fberr (float): background flux uncertainty.
+
+    Raises:
+        np.linalg.LinAlgError: if fs and fb are undetermined, e.g. the magnification is constant.
     """
+    iamp = _mulens_magnification(times, t_0, t_E, u_0, lgrho, lgq, lgs, alpha_180)
+    chi2, fs, fb, fserr, fberr = get_fsfb(iamp, iflux, iferr)
+    if not np.isfinite(chi2):
+        raise np.linalg.LinAlgError('fs and fb are undetermined by the magnification')
+    return chi2, fs, fb, fserr, fberr
+
+def _mulens_magnification(times, t_0, t_E, u_0, lgrho, lgq, lgs, alpha_180):
     parameters = {
             't_0': t_0,
             't_E': t_E,
@@ -99,25 +77,7 @@ def getfsfb(times, iflux, iferr, t_0, t_E, u_0, lgrho, lgq, lgs, alpha_180, **kw
         }
     modelmm = mm.Model(parameters, coords=None)
     modelmm.set_magnification_methods([parameters['t_0']-2*parameters['t_E'], 'VBBL', parameters['t_0']+2*parameters['t_E']])
-    iamp = modelmm.get_magnification(times)
-    sig2 = iferr**2
-    wght = iflux/sig2
-    d = np.ones(2)
-    d[0] = np.sum(wght*iamp)
-    d[1] = np.sum(wght)
-    b = np.zeros((2,2))
-    b[0,0] = np.sum(iamp**2/sig2)
-    b[0,1] = np.sum(iamp/sig2)
-    b[1,0] = b[0,1]
-    b[1,1] = np.sum(1./sig2)
-    c = np.linalg.inv(b)
-    fs = np.sum(c[0]*d)
-    fb = np.sum(c[1]*d)
-    fserr = np.sqrt(c[0,0])
-    fberr = np.sqrt(c[1,1])
-    fmod = fs*iamp+fb
-    chi2 = np.sum((iflux-fmod)**2/sig2)
-    return chi2,fs,fb,fserr,fberr
+    return modelmm.get_magnification(times)
 
 def infer_lgfs(X, pred, relative_uncertainty=0.03):
     """Infer the logarithm of the source flux for each light curve in a dataset.
@@ -128,20 +88,65 @@ def infer_lgfs(X, pred, relative_uncertainty=0.03):
         relative_uncertainty (float, optional): relative uncertainty of the light curve computed in flux. Defaults to 0.03.
 
     Returns:
-        pred (array): the input pred appended with the inferred logarithm of the source flux.
+        pred (array): the input pred appended with the inferred logarithm of the source flux, NaN where the
+            magnification leaves fs and fb undetermined.
     """
-    lgfs = np.zeros((pred.shape[0], 1))
-    for i in tqdm(range(pred.shape[0])):
-        times = X[i, :, 0]
-        iflux = 10 ** (X[i, :, 1] / 5 / (-2.5))
-        iferr = relative_uncertainty * iflux
-        chi2, fs, fb, fserr, fberr = getfsfb(times, iflux, iferr, 0, 1, pred[i, 0], -3, pred[i, 1], pred[i, 2], pred[i, 3])
-        lgfs[i, 0] = np.log10(fs / (fs + fb))
+    times = X[:, :, 0]
+    iflux = 10 ** (X[:, :, 1] / 5 / (-2.5))
+    iferr = relative_uncertainty * iflux
+    iamp = np.stack([_mulens_magnification(times[i], 0, 1, pred[i, 0], -3, pred[i, 1], pred[i, 2], pred[i, 3]) for i in tqdm(range(pred.shape[0]))])
+    # one flux solve for the whole dataset
+    chi2, fs, fb, fserr, fberr = get_fsfb(iamp, iflux, iferr)
+    if not np.isfinite(chi2).all():
+        logging.warning(f'fs and fb undetermined for {np.sum(~np.isfinite(chi2))} light curves, their lgfs is NaN')
+    lgfs = np.log10(fs / (fs + fb))[:, None]
     pred = np.hstack([pred, lgfs])
     return pred
 
 
-def inference(model, total_size, batch_size, coeffs, device='cpu', full_cov=False, **kwargs):
+def iter_inference(model, total_size, batch_size, coeffs, device='cpu', full_cov=False, lengths=None, skip=()):
+    """Infer the posterior distribution batch by batch, yielding the results of each batch as soon as it is done.
+
+    Args:
+        model (estimator): the estimator.
+        total_size (int): total size of the dataset.
+        batch_size (int): batch size.
+        coeffs (tensor): preprocessed light curve data, shape (total_size, :).
+        device (str, optional): torch device. Defaults to 'cpu'.
+        full_cov (bool, optional): whether to use diagonal covariance of full covariance Gaussians. Defaults to False.
+        lengths (tensor, optional): true lengths of the padded sequences, shape (total_size,). See `inference`. Defaults to None.
+        skip (container, optional): numbers of the batches to skip. Defaults to ().
+
+    Yields:
+        i (int): number of the batch.
+        ind (tensor): indices of the light curves in the batch.
+        pi, loc, scale (tensor): predicted weights, means and variances of the Gaussian mixture of the batch.
+    """
+    num = total_size
+    batchsize = batch_size
+    if lengths is None:
+        batches = [torch.arange(i*batchsize, min(i*batchsize+batchsize, num)) for i in range(int(np.ceil(num / batchsize)))]
+    else:
+        lengths = torch.as_tensor(lengths)[:num]
+        batches = length_buckets(lengths, batchsize)
+    model.eval()
+    with torch.no_grad():
+        for i, ind in enumerate(tqdm(batches)):
+            if i in skip:
+                continue
+            if lengths is None:
+                batch = coeffs[ind[0]:ind[-1]+1].float().to(device)
+                pi, normal = model(batch)
+            else:
+                batch = trim_to_bucket(coeffs[ind], lengths[ind]).float().to(device)
+                pi, normal = model(batch, lengths=lengths[ind].to(device))
+            if full_cov:
+                scale = normal.covariance_matrix.detach().cpu()
+            else:
+                scale = normal.scale.detach().cpu()
+            yield i, ind, pi.probs.detach().cpu(), normal.loc.detach().cpu(), scale
+
+def inference(model, total_size, batch_size, coeffs, device='cpu', full_cov=False, lengths=None, output=None, **kwargs):
     """Infer the posterior distribution of the parameters given the preprocessed light curve dataset.
 
     Args:
@@ -151,14 +156,20 @@ def inference(model, total_size, batch_size, coeffs, device='cpu', full_cov=Fals
         coeffs (tensor): preprocessed light curve data, shape (total_size, :).
         device (str, optional): torch device. Defaults to 'cpu'.
         full_cov (bool, optional): whether to use diagonal covariance of full covariance Gaussians. Defaults to False.
+        lengths (tensor, optional): true lengths of the padded sequences, shape (total_size,). If given, light curves of similar lengths are batched together and each one ends its integration at its own end time. Defaults to None.
+        output (str, optional): path of an HDF5 file. If given, the results of each batch are written to the file as soon as they are computed
+            instead of being kept in memory, and batches already completed in an existing file are skipped, so an interrupted run can be resumed
+            with the same arguments. Defaults to None.
 
     Returns:
         pis (tensor): predicted weights of the Gaussian mixture, shape (total_size, n_components).
         locs (tensor): predicted means of the Gaussians, shape (total_size, n_components, n_parameters).
         scales (tensor): predicted variances of the Gaussians, shape (total_size, n_components, n_parameters) if full_cov==False, shape (total_size, n_components, n_parameters, n_parameters) if full_cov==True.
+        If output is given, the path of the HDF5 file with the datasets 'pis', 'locs' and 'scales' is returned instead.
     """
+    if output is not None:
+        return _inference_to_file(model, total_size, batch_size, coeffs, device, full_cov, lengths, output)
     num = total_size
-    batchsize = batch_size
     n_gaussian = model.n_gaussian
     output_dim = model.output_dim
     pis = torch.zeros((num, n_gaussian))
@@ -167,20 +178,68 @@ def inference(model, total_size, batch_size, coeffs, device='cpu', full_cov=Fals
         scales = torch.zeros((num, n_gaussian, output_dim, output_dim))
     else:
         scales = torch.zeros((num, n_gaussian, output_dim))
-    model.eval()
-    with torch.no_grad():
-        for i in tqdm(range(int(np.ceil(num / batchsize)))):
-            batch = coeffs[i*batchsize:min(i*batchsize+batchsize, num)].float().to(device)
-            pi, normal = model(batch)
-            pis[i*batchsize:min(i*batchsize+batchsize, num)] = pi.probs.detach().cpu()
-            locs[i*batchsize:min(i*batchsize+batchsize, num)] = normal.loc.detach().cpu()
-            if full_cov:
-                scales[i*batchsize:min(i*batchsize+batchsize, num)] = normal.covariance_matrix.detach().cpu()
-            else:
-                scales[i*batchsize:min(i*batchsize+batchsize, num)] = normal.scale.detach().cpu()
+    for _, ind, pi, loc, scale in iter_inference(model, total_size, batch_size, coeffs, device, full_cov, lengths):
+        pis[ind] = pi
+        locs[ind] = loc
+        scales[ind] = scale
     return pis, locs, scales
 
-def get_loglik(pi, loc, scale, x, margin_dim, exp=False, individual_gaussian=False):
+def _inference_to_file(model, total_size, batch_size, coeffs, device, full_cov, lengths, output):
+    import h5py
+
+    n_gaussian = model.n_gaussian
+    output_dim = model.output_dim
+    n_batches = int(np.ceil(total_size / batch_size))
+    config = {'total_size': total_size, 'batch_size': batch_size, 'full_cov': full_cov, 'bucketed': lengths is not None}
+    shapes = {
+        'pis': (n_gaussian,),
+        'locs': (n_gaussian, output_dim),
+        'scales': (n_gaussian, output_dim, output_dim) if full_cov else (n_gaussian, output_dim),
+    }
+    with h5py.File(output, mode='a') as f:
+        if 'done' in f:
+            for key, value in config.items():
+                if f.attrs[key] != value:
+                    raise ValueError(f'{output} was written with {key}={f.attrs[key]}, cannot resume with {key}={value}')
+        else:
+            f.attrs.update(config)
+            for key, shape in shapes.items():
+                f.create_dataset(key, shape=(total_size, *shape), dtype='float32', chunks=(min(batch_size, total_size), *shape))
+            f.create_dataset('done', shape=(n_batches,), dtype=bool)
+        done = set(np.where(f['done'][...])[0].tolist())
+        if len(done) > 0:
+            logging.info(f'resuming {output}: {len(done)}/{n_batches} batches already done')
+        for i, ind, pi, loc, scale in iter_inference(model, total_size, batch_size, coeffs, device, full_cov, lengths, skip=done):
+            # h5py only accepts increasing indices
+            order = torch.argsort(ind)
+            ind = ind[order].numpy()
+            f['pis'][ind] = pi[order].numpy()
+            f['locs'][ind] = loc[order].numpy()
+            f['scales'][ind] = scale[order].numpy()
+            f['done'][i] = True
+            f.flush()
+    return output
+
+def get_loglik(pi, loc, scale, x, margin_dim, exp=False, individual_gaussian=False, max_elements=None, n_threads=1):
+    """Marginal log likelihood of the Gaussian mixtures along one parameter.
+
+    Args:
+        pi (tensor): weights of the Gaussian mixture, shape (n_light_curves, n_components).
+        loc (tensor): means of the Gaussians, shape (n_light_curves, n_components, n_parameters).
+        scale (tensor): variances of the Gaussians, shape (n_light_curves, n_components, n_parameters) or (n_light_curves, n_components, n_parameters, n_parameters).
+        x (tensor): values of the parameter, shape (n_grid, n_light_curves, 1).
+        margin_dim (int): index of the parameter.
+        exp (bool, optional): whether to return the likelihood instead of the log likelihood. Defaults to False.
+        individual_gaussian (bool, optional): whether to return the log likelihood of each Gaussian instead of the mixture. Defaults to False.
+        max_elements (int, optional): if given, events and grid points are processed in blocks of at most about this many (grid point, event, component)
+            elements, which bounds the memory regardless of the size of the grid. Defaults to None, i.e. all at once.
+        n_threads (int, optional): number of threads processing the blocks. Defaults to 1.
+
+    Returns:
+        loglik (tensor): shape (n_grid, n_light_curves), or (n_grid, n_light_curves, n_components) if individual_gaussian.
+    """
+    if max_elements is not None:
+        return _get_loglik_chunked(pi, loc, scale, x, margin_dim, exp, individual_gaussian, max_elements, n_threads)
     shape = x.shape
     if len(scale.shape) > len(loc.shape):
         # for full covariance
@@ -197,7 +256,69 @@ def get_loglik(pi, loc, scale, x, margin_dim, exp=False, individual_gaussian=Fal
         return torch.exp(loglik)
     return loglik
 
-def get_peak_pred(pis, locs, scales, Y, n_step=1000, verbose=False):
+def _get_loglik_chunked(pi, loc, scale, x, margin_dim, exp, individual_gaussian, max_elements, n_threads):
+    shape = x.shape
+    num, n_comp = loc.shape[0], loc.shape[1]
+    x = x.reshape(-1, num)
+    n_grid = x.shape[0]
+    event_chunk = min(num, max(max_elements // n_comp, 1))
+    grid_chunk = min(n_grid, max(max_elements // (event_chunk * n_comp), 1))
+    out_shape = (n_grid, num, n_comp) if individual_gaussian else (n_grid, num)
+    loglik = torch.empty(out_shape, dtype=torch.promote_types(loc.dtype, x.dtype), device=loc.device)
+
+    def block(index):
+        g, e = index
+        loglik[g:g+grid_chunk, e:e+event_chunk] = get_loglik(pi[e:e+event_chunk], loc[e:e+event_chunk], scale[e:e+event_chunk],
+                                                              x[g:g+grid_chunk, e:e+event_chunk, None], margin_dim, exp, individual_gaussian)
+
+    blocks = [(g, e) for e in range(0, num, event_chunk) for g in range(0, n_grid, grid_chunk)]
+    if n_threads > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(executor.map(block, blocks))
+    else:
+        for index in blocks:
+            block(index)
+    if individual_gaussian:
+        return loglik.reshape(*shape[:-1], n_comp)
+    return loglik.reshape(shape[:-1])
+
+def find_peaks_batched(x):
+    """Find the local maxima of each row, like `scipy.signal.find_peaks` without conditions, for all rows at once.
+
+    A peak is a sample, or the middle (rounded down) of a flat run of samples, whose neighbours on both sides are strictly smaller.
+    The first and last samples are never peaks.
+
+    Args:
+        x (tensor): signals, shape (n_rows, n_samples).
+
+    Returns:
+        peaks (tensor): boolean mask of the peaks, shape (n_rows, n_samples).
+    """
+    peaks = torch.zeros_like(x, dtype=torch.bool)
+    peaks[:, 1:-1] = (x[:, 1:-1] > x[:, :-2]) * (x[:, 1:-1] > x[:, 2:])
+    # flat runs are rare, only handle them on the rows that have some
+    flat = (x[:, 1:] == x[:, :-1]).any(dim=-1)
+    if flat.any():
+        peaks[flat] = _find_flat_peaks(x[flat])
+    return peaks
+
+def _find_flat_peaks(x):
+    n = x.shape[-1]
+    index = torch.arange(n, device=x.device).expand_as(x)
+    new_run = torch.ones_like(x, dtype=torch.bool)
+    new_run[:, 1:] = x[:, 1:] != x[:, :-1]
+    # first and last index of the flat run containing each sample
+    run_start = torch.cummax(torch.where(new_run, index, torch.zeros_like(index)), dim=-1).values
+    end_run = torch.ones_like(new_run)
+    end_run[:, :-1] = new_run[:, 1:]
+    run_end = torch.flip(torch.cummin(torch.flip(torch.where(end_run, index, torch.full_like(index, n - 1)), [-1]), dim=-1).values, [-1])
+    inside = (run_start > 0) * (run_end < n - 1)
+    left = x.gather(-1, (run_start - 1).clamp(min=0))
+    right = x.gather(-1, (run_end + 1).clamp(max=n - 1))
+    return inside * (left < x) * (right < x) * (index == torch.div(run_start + run_end, 2, rounding_mode='floor'))
+
+def get_peak_pred(pis, locs, scales, Y, n_step=1000, verbose=False, max_elements=2**20, n_threads=1):
     """Get the global peak and combined marginal closest peak as the prediction of the MDN posterior.
 
     Args:
@@ -207,6 +328,8 @@ def get_peak_pred(pis, locs, scales, Y, n_step=1000, verbose=False):
         Y (tensor): ground truth, shape (n_light_curves, n_parameters).
         n_step (int, optional): number of steps when dividing the parameter interval. Defaults to 1000.
         verbose (bool, optional): whether to print the progress. Defaults to False.
+        max_elements (int, optional): memory budget of the marginal log likelihood, see `get_loglik`. Defaults to 2**20.
+        n_threads (int, optional): number of threads evaluating the marginal log likelihood. Defaults to 1.
 
     Returns:
         pred_global (tensor): global peak, shape (n_light_curves, n_parameters).
@@ -225,32 +348,163 @@ def get_peak_pred(pis, locs, scales, Y, n_step=1000, verbose=False):
         torch.linspace(0, 2, n_step),
         torch.linspace(-1, 0, n_step)]
     for dim in tqdm(range(output_dim)):
-        param_list = grid[dim].reshape(-1, 1, 1).tile(1, num, 1) 
-        loglik = get_loglik(pis, locs, scales, param_list, margin_dim=dim, exp=False).transpose(1, 0)
-        for i in tqdm(range(num)):
-            peaks = find_peaks(loglik[i])[0]
-            if len(peaks) == 0:
-                pred_global[i, dim] = grid[dim][torch.argmax(loglik[i])]
-                pred_close[i, dim] = grid[dim][torch.argmax(loglik[i])]
-                pred_global_loglik[i, dim] = torch.max(loglik[i])
-                pred_close_loglik[i, dim] = torch.max(loglik[i])
-                if verbose:
-                    print('no peak found, use maximum instead')
-                    plt.plot(grid[dim], loglik[i])
-                    plt.vlines(Y[i, dim], 0, 10, color='red')
-                    plt.vlines(grid[dim][torch.argmax(loglik[i])], 0, 10, color='blue')
-                    print(Y[i, dim])
-                    plt.show()
-            else:
-                order = torch.argsort(loglik[i, peaks], descending=True)
-                global_peak = grid[dim][peaks[order[0]]]
-                close_peak = grid[dim][peaks][torch.argmin((grid[dim][peaks] - Y[i, dim])**2)]
-                pred_global[i, dim] = global_peak
-                pred_close[i, dim] = close_peak
-                pred_global_loglik[i, dim] = loglik[i][peaks[order[0]]]
-                pred_close_loglik[i, dim] = loglik[i][peaks][torch.argmin((grid[dim][peaks] - Y[i, dim])**2)]
+        param_list = grid[dim].reshape(-1, 1, 1).expand(-1, num, 1)
+        loglik = get_loglik(pis, locs, scales, param_list, margin_dim=dim, exp=False, max_elements=max_elements, n_threads=n_threads).transpose(1, 0)
+        peaks = find_peaks_batched(loglik)
+        no_peak = ~peaks.any(dim=-1)
+        # without any peak, use the maximum instead
+        peaks[no_peak] = F.one_hot(torch.argmax(loglik[no_peak], dim=-1), n_step).bool()
+        global_peak = torch.argmax(torch.where(peaks, loglik, torch.full_like(loglik, -float('inf'))), dim=-1)
+        distance = (grid[dim][None] - Y[:num, [dim]])**2
+        close_peak = torch.argmin(torch.where(peaks, distance, torch.full_like(distance, float('inf'))), dim=-1)
+        pred_global[:, dim] = grid[dim][global_peak]
+        pred_close[:, dim] = grid[dim][close_peak]
+        pred_global_loglik[:, dim] = loglik.gather(-1, global_peak[:, None])[:, 0]
+        pred_close_loglik[:, dim] = loglik.gather(-1, close_peak[:, None])[:, 0]
+        if verbose:
+            for i in torch.where(no_peak)[0].tolist():
+                print('no peak found, use maximum instead')
+                plt.plot(grid[dim], loglik[i])
+                plt.vlines(Y[i, dim], 0, 10, color='red')
+                plt.vlines(grid[dim][torch.argmax(loglik[i])], 0, 10, color='blue')
+                print(Y[i, dim])
+                plt.show()
     return pred_global, pred_global_loglik, pred_close, pred_close_loglik
 
+def _mixture_log_prob(pis, locs, scales, x, full_cov):
+    """Log density of each Gaussian of the mixtures at the points x, shape (num, n_points, n_components)."""
+    diff = x[:, :, None] - locs[:, None]
+    d = locs.shape[-1]
+    if full_cov:
+        L = torch.linalg.cholesky(scales)
+        z = torch.linalg.solve_triangular(L[:, None].expand(*diff.shape, d), diff.unsqueeze(-1), upper=False)[..., 0]
+        log_det = torch.log(torch.diagonal(L, dim1=-2, dim2=-1)).sum(dim=-1)
+    else:
+        z = diff / scales[:, None]
+        log_det = torch.log(scales).sum(dim=-1)
+    return torch.log(pis)[:, None] - 0.5 * (z**2).sum(dim=-1) - log_det[:, None] - 0.5 * d * np.log(2 * np.pi)
+
+def get_modes(pis, locs, scales, n_iter=500, tol=1e-5, merge_tol=1e-3):
+    """Find the modes of the joint posterior of each light curve by fixed-point iteration from every component mean.
+
+    Each step moves a point x to the maximum of the quadratic lower bound of the mixture density at x,
+    x <- (sum_k r_k P_k)^-1 sum_k r_k P_k mu_k, with r_k the responsibilities of the Gaussians at x and P_k their precisions.
+    The density never decreases along the iteration, and all light curves and starting points are processed at once.
+
+    Args:
+        pis (tensor): weights of the Gaussian mixture, shape (n_light_curves, n_components).
+        locs (tensor): means of the Gaussians, shape (n_light_curves, n_components, n_parameters).
+        scales (tensor): standard deviations of the Gaussians, shape (n_light_curves, n_components, n_parameters), or covariance matrices, shape (n_light_curves, n_components, n_parameters, n_parameters).
+        n_iter (int, optional): maximum number of iterations. Defaults to 500.
+        tol (float, optional): a light curve stops once none of its points moves more than tol. Defaults to 1e-5.
+        merge_tol (float, optional): modes closer than merge_tol to a higher mode are marked as duplicates. Defaults to 1e-3.
+
+    Returns:
+        modes (tensor): modes sorted by decreasing log density, shape (n_light_curves, n_components, n_parameters).
+        loglik (tensor): log density of the mixture at the modes, shape (n_light_curves, n_components).
+        unique (tensor): False for the modes duplicating a higher one, shape (n_light_curves, n_components).
+    """
+    full_cov = len(scales.shape) > len(locs.shape)
+    if full_cov:
+        precision = torch.cholesky_inverse(torch.linalg.cholesky(scales))
+        precision_loc = (precision @ locs.unsqueeze(-1))[..., 0]
+    else:
+        precision = scales**-2
+        precision_loc = precision * locs
+
+    x = locs.clone()
+    # light curves still moving
+    active = torch.arange(len(x), device=x.device)
+    for _ in range(n_iter):
+        r = torch.softmax(_mixture_log_prob(pis[active], locs[active], scales[active], x[active], full_cov), dim=-1)
+        if full_cov:
+            A = torch.einsum('nsk,nkij->nsij', r, precision[active])
+            b = torch.einsum('nsk,nki->nsi', r, precision_loc[active])
+            x_new = torch.linalg.solve(A, b)
+        else:
+            x_new = (r @ precision_loc[active]) / (r @ precision[active])
+        moving = torch.abs(x_new - x[active]).flatten(1).max(dim=-1).values >= tol
+        x[active] = x_new
+        active = active[moving]
+        if len(active) == 0:
+            break
+
+    loglik = torch.logsumexp(_mixture_log_prob(pis, locs, scales, x, full_cov), dim=-1)
+    order = torch.argsort(loglik, dim=-1, descending=True)
+    modes = torch.gather(x, 1, order[..., None].expand_as(x))
+    loglik = torch.gather(loglik, 1, order)
+    distance = torch.cdist(modes, modes)
+    higher = torch.ones_like(distance, dtype=torch.bool).triu(diagonal=1).transpose(-1, -2)
+    unique = ~((distance < merge_tol) * higher).any(dim=-1)
+    return modes, loglik, unique
+
+def reduce_mixture(pis, locs, scales, min_weight=1e-2, threshold=1., max_components=None):
+    """Merge nearly identical Gaussians and drop negligible ones, to get one seed per distinct mode for the optimization.
+
+    Components are visited by decreasing weight. Each one not yet merged absorbs all the remaining components within
+    squared distance `threshold`, with the distance (mu_i - mu_j)^T (Sigma_i + Sigma_j)^-1 (mu_i - mu_j), and the merged
+    component matches the weight, mean and covariance of the ones it absorbed. All light curves are processed at once.
+
+    Args:
+        pis (tensor): weights of the Gaussian mixture, shape (n_light_curves, n_components).
+        locs (tensor): means of the Gaussians, shape (n_light_curves, n_components, n_parameters).
+        scales (tensor): standard deviations of the Gaussians, shape (n_light_curves, n_components, n_parameters), or covariance matrices, shape (n_light_curves, n_components, n_parameters, n_parameters).
+        min_weight (float, optional): components lighter than this are dropped, except the heaviest one. Defaults to 1e-2.
+        threshold (float, optional): squared distance below which components are merged. Defaults to 1.
+        max_components (int, optional): keep at most this many components per light curve. Defaults to None.
+
+    Returns:
+        pis (tensor): weights of the reduced mixture sorted in decreasing order and renormalized, zero for the unused slots, shape (n_light_curves, n_components).
+        locs (tensor): means of the reduced mixture, NaN for the unused slots.
+        scales (tensor): standard deviations or covariance matrices of the reduced mixture, NaN for the unused slots.
+        n_seeds (tensor): number of components left for each light curve, shape (n_light_curves,).
+    """
+    full_cov = len(scales.shape) > len(locs.shape)
+    num, n_comp, d = locs.shape
+    order = torch.argsort(pis, dim=-1, descending=True)
+    first_indices = torch.arange(num)[:, None]
+    pis, locs, scales = pis[first_indices, order], locs[first_indices, order], scales[first_indices, order]
+    cov = scales if full_cov else torch.diag_embed(scales**2)
+
+    alive = pis >= min_weight
+    alive[:, 0] = True
+    diff = locs[:, :, None] - locs[:, None]
+    distance = (diff.unsqueeze(-2) @ torch.linalg.solve(cov[:, :, None] + cov[:, None], diff.unsqueeze(-1)))[..., 0, 0]
+    # greedy clustering by decreasing weight, vectorized over light curves
+    head = torch.full((num, n_comp), -1, dtype=torch.long)
+    for r in range(n_comp):
+        new_head = alive[:, r] * (head[:, r] < 0)
+        absorb = new_head[:, None] * alive * (head < 0) * (distance[:, r] < threshold)
+        absorb[:, r] = new_head
+        head[absorb] = r
+    members = F.one_hot(head.clamp(min=0), n_comp).to(pis.dtype) * (head >= 0)[..., None]
+    members = members.transpose(1, 2) * pis[:, None]
+
+    weight = members.sum(dim=-1)
+    used = weight > 0
+    w = members / weight.clamp(min=1e-30)[..., None]
+    new_locs = w @ locs
+    spread = locs[:, None] - new_locs[:, :, None]
+    new_cov = torch.einsum('nhk,nkij->nhij', w, cov) + torch.einsum('nhk,nhki,nhkj->nhij', w, spread, spread)
+
+    n_seeds = used.sum(dim=-1)
+    if max_components is not None:
+        n_seeds = n_seeds.clamp(max=max_components)
+    # heads are in decreasing order of their own weight, sort again by the merged weight
+    weight = torch.where(used, weight, torch.full_like(weight, -1.))
+    order = torch.argsort(weight, dim=-1, descending=True)
+    keep = torch.arange(n_comp)[None] < n_seeds[:, None]
+    new_pis = torch.where(keep, weight[first_indices, order], torch.zeros_like(weight))
+    new_pis = new_pis / new_pis.sum(dim=-1, keepdim=True)
+    new_locs = torch.where(keep[..., None], new_locs[first_indices, order], torch.full_like(new_locs, float('nan')))
+    new_cov = new_cov[first_indices, order]
+    if full_cov:
+        new_scales = torch.where(keep[..., None, None], new_cov, torch.full_like(new_cov, float('nan')))
+    else:
+        new_scales = torch.sqrt(torch.diagonal(new_cov, dim1=-2, dim2=-1))
+        new_scales = torch.where(keep[..., None], new_scales, torch.full_like(new_scales, float('nan')))
+    return new_pis, new_locs, new_scales, n_seeds
+
 def plot_params(num, Y, pred_global, pred_global_loglik, pred_close, pred_close_loglik, 
                 title=None, figsize=(16, 8), labelsize=14, alpha=0.1, save=None,
                 example_groundtruth=np.ones(5)*np.inf, example_pred=np.ones(5)*np.inf):
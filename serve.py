@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+import torchcde
+
+from model.locator import load_locator
+from model.cde_mdn import load_estimator
+from model.preprocess import pad_lcs, locator_interval, rescale_lcs, logsig_windows_batched, trim_to_bucket
+
+parser = argparse.ArgumentParser('MAGIC server')
+parser.add_argument('--locator', type=str, default='/work/hmzhao/experiments/locator/experiment_54125.ckpt', help="Path of the locator checkpoint")
+parser.add_argument('--estimator', type=str, default='/work/hmzhao/experiments/cde_mdn/experiment_l32nG12diag.ckpt', help="Path of the estimator checkpoint")
+parser.add_argument('-k', type=float, default=1/3, help="k of the locator")
+parser.add_argument('--method', type=str, default='diff', help="Method of the locator, diff or avg")
+parser.add_argument('--full-cov', action='store_true', help="Whether the estimator uses full covariance")
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--socket', type=str, default=None, help="Path of a Unix socket to listen on instead of host:port")
+parser.add_argument('-b', '--max-batch-size', type=int, default=64, help="Maximum size of a dynamic batch")
+parser.add_argument('--max-latency', type=float, default=0.05, help="Maximum time (s) a request waits for its batch to fill")
+parser.add_argument('--device', type=str, default='cpu')
+parser.add_argument('--threads', type=int, default=None, help="Number of CPU threads")
+
+
+class DynamicBatcher(object):
+    '''
+    Group concurrent requests into batches.
+
+    A batch is closed when it reaches max_batch_size or when its oldest request has waited max_latency seconds.
+
+    Args:
+            predict (callable): function mapping a list of inputs to a list of outputs.
+            max_batch_size (int, optional): maximum size of a batch. Defaults to 64.
+            max_latency (float, optional): maximum waiting time (s) of a request before its batch is run. Defaults to 0.05.
+            history (int, optional): number of recent requests kept for the latency metrics. Defaults to 10000.
+    '''
+    def __init__(self, predict, max_batch_size=64, max_latency=0.05, history=10000):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.n_requests = 0
+        self.n_errors = 0
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, x):
+        future = Future()
+        self.queue.put((time.time(), x, future))
+        return future
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = batch[0][0] + self.max_latency
+        while len(batch) < self.max_batch_size:
+            # past the deadline, only take the requests already waiting
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                outputs = self.predict([x for _, x, _ in batch])
+            except Exception as e:
+                outputs = [e] * len(batch)
+            now = time.time()
+            with self.lock:
+                self.batch_sizes.append(len(batch))
+                for (arrival, _, future), output in zip(batch, outputs):
+                    self.latencies.append(now - arrival)
+                    self.n_requests += 1
+                    if isinstance(output, Exception):
+                        self.n_errors += 1
+                        future.set_exception(output)
+                    else:
+                        future.set_result(output)
+
+    def metrics(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            batch_sizes = np.array(self.batch_sizes)
+            n_requests, n_errors = self.n_requests, self.n_errors
+        metrics = {
+            'queue_size': self.queue.qsize(),
+            'n_requests': n_requests,
+            'n_errors': n_errors,
+            'uptime': time.time() - self.start_time,
+            'mean_batch_size': float(batch_sizes.mean()) if len(batch_sizes) else 0.,
+        }
+        for p in [50, 95, 99]:
+            metrics[f'latency_p{p}'] = float(np.percentile(latencies, p)) if len(latencies) else 0.
+        return metrics
+
+
+class MagicPredictor(object):
+    '''
+    Locate, rescale, compute the logsignature and estimate the posterior of a batch of raw light curves.
+
+    Args:
+            locator (Locator): the locator.
+            estimator (CDE_MDN): the estimator.
+            device (str, optional): torch device. Defaults to 'cpu'.
+            full_cov (bool, optional): whether the estimator uses full covariance. Defaults to False.
+
+    Returns:
+            outputs (list): for each light curve, a dict of t_0, t_E and the mixture parameters pis, locs, scales, or a ValueError if the light curve failed preprocessing.
+    '''
+    def __init__(self, locator, estimator, device='cpu', full_cov=False):
+        self.locator = locator
+        self.estimator = estimator
+        self.device = device
+        self.full_cov = full_cov
+
+    def __call__(self, lcs):
+        X, lengths = pad_lcs([torch.as_tensor(lc, dtype=torch.float)[:, :2] for lc in lcs])
+        coeffs = torchcde.hermite_cubic_coefficients_with_backward_differences(X)
+        reg = self.locator.predict(coeffs, interval=locator_interval(lengths, self.locator.n_intervals)).cpu()
+
+        X = rescale_lcs(X, reg, lengths)
+        logsig, lengths, failures = logsig_windows_batched(X, lengths=lengths)
+        outputs = [None] * len(lcs)
+        for failure in failures:
+            outputs[failure['index']] = ValueError(failure['reason'])
+
+        ok = torch.where(lengths > 0)[0]
+        if len(ok) > 0:
+            coeffs = torchcde.hermite_cubic_coefficients_with_backward_differences(logsig[ok])
+            coeffs = trim_to_bucket(coeffs, lengths[ok])
+            with torch.no_grad():
+                pi, normal = self.estimator(coeffs.to(self.device), lengths=lengths[ok].to(self.device))
+            pis = pi.probs.cpu()
+            locs = normal.loc.cpu()
+            scales = normal.covariance_matrix.cpu() if self.full_cov else normal.scale.cpu()
+            for j, i in enumerate(ok.tolist()):
+                outputs[i] = {
+                    't_0': reg[i, 0].item(),
+                    't_E': reg[i, 1].item(),
+                    'pis': pis[j].tolist(),
+                    'locs': locs[j].tolist(),
+                    'scales': scales[j].tolist(),
+                }
+        return outputs
+
+
+class MagicRequestHandler(BaseHTTPRequestHandler):
+    '''
+    POST /predict with {"lc": [[t, mag], ...]} returns the mixture parameters, GET /metrics returns the batcher metrics.
+    '''
+    batcher = None
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._send(200, self.batcher.metrics())
+        else:
+            self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send(404, {'error': 'not found'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            lc = np.asarray(body['lc'], dtype=np.float32)
+            if lc.ndim != 2 or lc.shape[1] < 2 or len(lc) < 2:
+                raise ValueError('lc must be a list of at least 2 [t, mag] rows')
+        except (KeyError, TypeError, ValueError) as e:
+            self._send(400, {'error': str(e)})
+            return
+        try:
+            self._send(200, self.batcher.submit(lc).result())
+        except ValueError as e:
+            self._send(422, {'error': str(e)})
+        except Exception as e:
+            self._send(500, {'error': repr(e)})
+
+    def address_string(self):
+        # client_address is empty on Unix sockets
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    print('loading locator')
+    locator = load_locator(args.locator, args.device, k=args.k, method=args.method)
+    print('loading estimator')
+    # (t, mag) paths with depth 3 logsignatures have 5 channels
+    estimator = load_estimator(args.estimator, 5, 5, args.device, full_cov=args.full_cov)
+    # quantized estimators always run on CPU
+    device = next(estimator.parameters()).device
+
+    MagicRequestHandler.batcher = DynamicBatcher(MagicPredictor(locator, estimator, device, args.full_cov),
+                                                 max_batch_size=args.max_batch_size, max_latency=args.max_latency)
+    if args.socket is not None:
+        server = UnixHTTPServer(args.socket, MagicRequestHandler)
+        print(f'serving on {args.socket}')
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), MagicRequestHandler)
+        print(f'serving on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        sys.exit(0)
@@ -1,9 +1,13 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas
 import VBBinaryLensing
 from scipy.optimize import minimize, fmin
 
+from model.fluxes import get_fsfb
+
 def input_data(lc_file, mdn_file):
     lc_data = np.loadtxt(lc_file, delimiter=',')
     time = lc_data[:, 0]
@@ -26,40 +30,28 @@ def input_data(lc_file, mdn_file):
 #    print(mdn)
     return lc, mdn
 
-def get_fsfb(amp, flux, ferr):
-    sig2 = ferr**2
-    wght = flux/sig2
-    d = np.ones(2)
-    d[0] = np.sum(wght*amp)
-    d[1] = np.sum(wght)
-    b = np.zeros((2,2))
-    b[0,0] = np.sum(amp**2/sig2)
-    b[0,1] = np.sum(amp/sig2)
-    b[1,0] = b[0,1]
-    b[1,1] = np.sum(1./sig2)
-    c = np.linalg.inv(b)
-    fs = np.sum(c[0]*d)
-    fb = np.sum(c[1]*d)
-    fserr = np.sqrt(c[0,0])
-    fberr = np.sqrt(c[1,1])
-    fmod = fs*amp+fb
-    chi2 = np.sum((flux-fmod)**2/sig2)
-    return chi2,fs,fb,fserr,fberr
-
-
 def compute_model_lc(time_array, fitting_parameters, VBBL):
     u0, lgq, lgs, ad180 = fitting_parameters
     q, s = 10**lgq, 10**lgs
     alpha = ad180 * np.pi # convert to radian
     t0, te, rho = 0, 1, 1e-3
-    tau = (time_array-t0)/te
-    xs = tau*np.cos(alpha) - u0*np.sin(alpha)
-    ys = tau*np.sin(alpha) + u0*np.cos(alpha)
-    magnifications = np.array([VBBL.BinaryMag2(s, q, xs[i], ys[i], rho) for i in range(len(xs))])
+    # the whole trajectory in one native call
+    # VBBL's source trajectory is (-xs, -ys) of ours, i.e. alpha + pi
+    params = [np.log(s), np.log(q), u0, alpha + np.pi, np.log(rho), np.log(te), t0]
+    magnifications = np.array(VBBL.BinaryLightCurve(params, time_array)[0])
     return magnifications
 
+_VBBL = None
+
+def get_vbbl():
+    # one VBBinaryLensing instance per process, as in opt.py
+    global _VBBL
+    if _VBBL is None:
+        _VBBL = VBBinaryLensing.VBBinaryLensing()
+    return _VBBL
+
 def perform_optimization(time, flux, ferr, para_initial):
-    VBBL = VBBinaryLensing.VBBinaryLensing()
+    VBBL = get_vbbl()
     
     def compute_chisq(fitting_parameters, time, flux, ferr, VBBL, return_model=False):
         magnifications = compute_model_lc(time, fitting_parameters, VBBL)
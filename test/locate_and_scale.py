@@ -3,10 +3,10 @@ import h5py
 import torch
 import torchcde
 from tqdm import tqdm
-import matplotlib.pyplot as plt
 
 from model.locator import Locator
 from model.scaler import Scaler
+from model.preprocess import logsig_windows_batched
 
 use_ground_truth = False
 use_ground_truth_fs = False
@@ -14,6 +14,7 @@ use_ground_truth_fs = False
 dataset = '/work/hmzhao/irregular-lc/roman-1-8dof.h5'
 device_1 = torch.device("cuda:4" if torch.cuda.is_available() else "cpu")
 device_2 = torch.device("cuda:4" if torch.cuda.is_available() else "cpu")
+n_workers = 16
 
 if __name__ == '__main__':
     with h5py.File(dataset, mode='r') as dataset_file:
@@ -85,16 +86,15 @@ if __name__ == '__main__':
         pred_s = torch.zeros((len(Y), 1))
         pred_rand = torch.zeros((len(Y), 2))
         pred_rand_s = torch.zeros((len(Y), 1))
-        z = torch.zeros((batchsize, 4000)).to(device_1)
         model_loc.eval()
         model_loc.threshold = 0.5
         model_sca.eval()
         for i in tqdm(range((len(Y) // batchsize) + 1)):
             batch = coeffs_even[i*batchsize:min(i*batchsize+batchsize, len(Y))].float().to(device_1)
             batch_rand = coeffs_rand[i*batchsize:min(i*batchsize+batchsize, len(Y))].float().to(device_1)
-            pred[i*batchsize:min(i*batchsize+batchsize, len(Y))] = model_loc(batch, z[:len(batch)])[0].detach().cpu()
+            pred[i*batchsize:min(i*batchsize+batchsize, len(Y))] = model_loc.predict(batch).cpu()
             pred_s[i*batchsize:min(i*batchsize+batchsize, len(Y))] = model_sca(batch).detach().cpu()
-            pred_rand[i*batchsize:min(i*batchsize+batchsize, len(Y))] = model_loc(batch_rand, z[:len(batch_rand)])[0].detach().cpu()
+            pred_rand[i*batchsize:min(i*batchsize+batchsize, len(Y))] = model_loc.predict(batch_rand).cpu()
             pred_rand_s[i*batchsize:min(i*batchsize+batchsize, len(Y))] = model_sca(batch_rand).detach().cpu()
 
     if use_ground_truth_fs:
@@ -111,41 +111,12 @@ if __name__ == '__main__':
     X_rand[:, :, 1] = X_rand[:, :, 1] / 1000 - (1 - (10. ** pred_rand_s)) / (10. ** pred_rand_s)
     X_rand[:, :, 1] = 22 - 2.5 * torch.log10(1000 * X_rand[:, :, 1])
 
-    max_len_even = 0
-    lc_even = []
-    max_len_rand = 0
-    lc_rand = []
-    for i in tqdm(range(len(Y))):
-        try:
-            lc = X_even[i]
-            lc = lc[torch.where((lc[:, 0] <= 2) * (lc[:, 0] >= -2))]
-            depth = 3; window_length = max(len(lc)//100, 1)
-            lc = torchcde.logsig_windows(lc, depth, window_length=window_length)
-            max_len_even = max(max_len_even, len(lc))
-            lc = torch.cat([lc, lc[-1].expand(X_even.shape[1] - len(lc), lc.shape[-1])])
-            lc_even.append(lc)
-        except:
-            print(X_even[i, :, 0])
-            plt.plot(X_even[i, :, 0], X_even[i, :, 1])
-            plt.show()
-            lc_rand.append(torch.ones(X_rand.shape[1], (lc_rand[-1]).shape[-1])*np.nan)
-
-        try:
-            lc = X_rand[i]
-            lc = lc[torch.where((lc[:, 0] <= 2) * (lc[:, 0] >= -2))]
-            depth = 3; window_length = max(len(lc)//100, 1)
-            lc = torchcde.logsig_windows(lc, depth, window_length=window_length)
-            max_len_rand = max(max_len_rand, len(lc))
-            lc = torch.cat([lc, lc[-1].expand(X_rand.shape[1] - len(lc), lc.shape[-1])])
-            lc_rand.append(lc)
-        except:
-            print(X_rand[i, :, 0])
-            plt.plot(X_rand[i, :, 0], X_rand[i, :, 1])
-            plt.show()
-            lc_rand.append(torch.ones(X_rand.shape[1], (lc_rand[-1]).shape[-1])*np.nan)
-
-    X_even = torch.stack(lc_even, dim=0)[:, :max_len_even]
-    X_rand = torch.stack(lc_rand, dim=0)[:, :max_len_rand]
+    X_even, len_even, failures_even = logsig_windows_batched(X_even, depth=3, tmin=-2, tmax=2, n_windows=100, n_workers=n_workers)
+    X_rand, len_rand, failures_rand = logsig_windows_batched(X_rand, depth=3, tmin=-2, tmax=2, n_windows=100, n_workers=n_workers)
+    for name, failures in [('even', failures_even), ('random', failures_rand)]:
+        print(f'{len(failures)} {name} light curves failed')
+        for failure in failures:
+            print(f"  #{failure['index']} ({failure['n_points']} points): {failure['reason']}")
 
     # save
     if use_ground_truth:
@@ -160,3 +131,9 @@ if __name__ == '__main__':
         dataset_file['Y'] = Y
         dataset_file['X_even'] = X_even
         dataset_file['X_random'] = X_rand
+        # true lengths before padding, for length bucketing in utils.inference
+        dataset_file['len_even'] = len_even
+        dataset_file['len_random'] = len_rand
+        # indices of the light curves that failed preprocessing
+        dataset_file['failed_even'] = np.array([failure['index'] for failure in failures_even], dtype=int)
+        dataset_file['failed_random'] = np.array([failure['index'] for failure in failures_rand], dtype=int)
@@ -0,0 +1,195 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import numpy as np
+from multiprocessing import Pool
+from tqdm import tqdm
+
+from model.fluxes import get_fsfb
+from opt import compute_model_lc, get_vbbl, MagnificationCache
+
+# flat prior of (u0, lgq, lgs) over the range of the simulated training set, see simulate/simulate.py
+# ad180 is periodic and left free, the samples are wrapped into [0, 2)
+PRIOR_BOUNDS = np.array([[-1, 1], [-3, 0], [np.log10(0.3), np.log10(3)]])
+
+
+def sample_mixture(pis, locs, scales, n_samples, rng):
+    """Draw samples of (u0, lgq, lgs, ad180) from the Gaussian mixture of the MDN.
+
+    Args:
+        pis (array): weights of the components, shape (n_gau,). NaN slots of a reduced mixture are skipped.
+        locs (array): means, shape (n_gau, 5), lgfs last.
+        scales (array): standard deviations, shape (n_gau, 5), or covariance matrices, shape (n_gau, 5, 5).
+        n_samples (int): number of samples.
+        rng (np.random.Generator): random generator.
+
+    Returns:
+        samples (array): shape (n_samples, 4).
+    """
+    valid = ~np.isnan(locs).any(axis=-1)
+    pis, locs, scales = pis[valid] / np.sum(pis[valid]), locs[valid, :-1], scales[valid]
+    component = rng.choice(len(pis), size=n_samples, p=pis)
+    if scales.ndim == 3:
+        # marginal of the first 4 dimensions
+        cov = scales[:, :-1, :-1]
+        return np.array([rng.multivariate_normal(locs[c], cov[c]) for c in component])
+    scales = scales[:, :-1]
+    return locs[component] + scales[component] * rng.standard_normal((n_samples, locs.shape[-1]))
+
+
+def log_prob(walkers, time, flux, ferr, VBBL, tol=None, cache=None):
+    """Log posterior of the walkers, -chi2/2 under the flat prior.
+
+    VBBL computes the light curves of the walkers one by one, as it has no batched entry point for different
+    lens parameters, but their fluxes are solved in one get_fsfb on the stacked magnifications, as in infer_lgfs.
+
+    Args:
+        walkers (array): positions (u0, lgq, lgs, ad180), shape (n_walkers, 4).
+        cache (MagnificationCache, optional): light curves of the event already computed. Defaults to None.
+
+    Returns:
+        log_prob (array): shape (n_walkers,), -inf outside the prior.
+    """
+    inside = np.all((walkers[:, :3] > PRIOR_BOUNDS[:, 0]) & (walkers[:, :3] < PRIOR_BOUNDS[:, 1]), axis=-1)
+    lp = np.full(len(walkers), -np.inf)
+    if not inside.any():
+        return lp
+    amp = np.array([compute_model_lc(time, p, VBBL, cache=cache, tol=tol) for p in walkers[inside]])
+    chi2 = get_fsfb(amp, flux, ferr)[0]
+    lp[inside] = np.where(np.isfinite(chi2), -0.5 * chi2, -np.inf)
+    return lp
+
+
+def ensemble_sample(log_prob_fn, p0, n_steps, a=2., rng=None):
+    """Affine-invariant ensemble sampler with the stretch move of Goodman & Weare (2010).
+
+    The walkers are split into two halves, and each half is moved at once using the other one,
+    so log_prob_fn is called on n_walkers / 2 positions at a time.
+
+    Args:
+        log_prob_fn (callable): log probability of an array of positions, shape (n, n_dim) -> (n,).
+        p0 (array): initial positions of the walkers, shape (n_walkers, n_dim), n_walkers even.
+        n_steps (int): number of steps.
+        a (float, optional): scale of the stretch move. Defaults to 2.
+        rng (np.random.Generator, optional): random generator. Defaults to None.
+
+    Returns:
+        chain (array): positions, shape (n_steps, n_walkers, n_dim).
+        log_probs (array): log probabilities, shape (n_steps, n_walkers).
+        acceptance (array): acceptance fraction of each walker, shape (n_walkers,).
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    p = np.array(p0, dtype=float)
+    n_walkers, n_dim = p.shape
+    lp = log_prob_fn(p)
+    chain = np.empty((n_steps, n_walkers, n_dim))
+    log_probs = np.empty((n_steps, n_walkers))
+    n_accepted = np.zeros(n_walkers)
+    halves = [np.arange(0, n_walkers // 2), np.arange(n_walkers // 2, n_walkers)]
+    for step in range(n_steps):
+        for active, complement in [halves, halves[::-1]]:
+            z = ((a - 1) * rng.random(len(active)) + 1)**2 / a
+            partner = p[rng.choice(complement, size=len(active))]
+            proposal = partner + z[:, None] * (p[active] - partner)
+            lp_proposal = log_prob_fn(proposal)
+            accept = np.log(rng.random(len(active))) < (n_dim - 1) * np.log(z) + lp_proposal - lp[active]
+            p[active[accept]] = proposal[accept]
+            lp[active[accept]] = lp_proposal[accept]
+            n_accepted[active[accept]] += 1
+        chain[step] = p
+        log_probs[step] = lp
+    return chain, log_probs, n_accepted / n_steps
+
+
+def initial_walkers(pis, locs, scales, n_walkers, rng, max_draws=10):
+    """Draw the initial walkers from the MDN mixture, keeping the draws inside the prior.
+
+    If the mixture puts too little mass inside the prior to fill the walkers in `max_draws` rounds, the coordinates
+    of the remaining draws that fall outside are drawn uniformly from the prior instead.
+
+    Returns:
+        p0 (array): initial positions, shape (n_walkers, 4).
+        n_inside (int): number of walkers drawn from the mixture as they are.
+    """
+    p0 = np.empty((0, 4))
+    for _ in range(max_draws):
+        draws = sample_mixture(pis, locs, scales, n_walkers, rng)
+        inside = np.all((draws[:, :3] > PRIOR_BOUNDS[:, 0]) & (draws[:, :3] < PRIOR_BOUNDS[:, 1]), axis=-1)
+        p0 = np.concatenate([p0, draws[inside]])[:n_walkers]
+        if len(p0) == n_walkers:
+            return p0, n_walkers
+    n_inside = len(p0)
+    draws = sample_mixture(pis, locs, scales, n_walkers - n_inside, rng)
+    outside = (draws[:, :3] <= PRIOR_BOUNDS[:, 0]) | (draws[:, :3] >= PRIOR_BOUNDS[:, 1])
+    uniform = rng.uniform(PRIOR_BOUNDS[:, 0], PRIOR_BOUNDS[:, 1], size=(len(draws), 3))
+    draws[:, :3] = np.where(outside, uniform, draws[:, :3])
+    return np.concatenate([p0, draws]), n_inside
+
+
+def run_event(task):
+    """Sample the posterior of one event, with walkers started from draws of its MDN mixture.
+
+    Returns (i, status, samples, log_probs, acceptance, runtime), samples being the thinned chain after burn-in
+    flattened over the walkers, shape (n_samples, 4), with ad180 wrapped into [0, 2). The status is 'ok', or
+    'failed: ...' if the mixture had too little mass inside the prior and some walkers were started from it,
+    see initial_walkers; the chain is still run, but should not be trusted.
+    """
+    i, lc_i, pis, locs, scales, n_walkers, n_steps, n_burn, thin, seed, tol = task
+    start = time.time()
+    rng = np.random.default_rng(seed)
+    VBBL = get_vbbl()
+    cache = MagnificationCache()
+    lc_i = lc_i[np.unique(lc_i[:, 0], return_index=True)[1]]
+    time_i, flux, ferr = lc_i[:, 0], lc_i[:, 2], lc_i[:, 3]
+
+    # walkers must start inside the prior
+    p0, n_inside = initial_walkers(pis, locs, scales, n_walkers, rng)
+    status = 'ok' if n_inside == n_walkers else f'failed: only {n_inside} of {n_walkers} walkers drawn inside the prior'
+
+    chain, log_probs, acceptance = ensemble_sample(lambda p: log_prob(p, time_i, flux, ferr, VBBL, tol=tol, cache=cache), p0, n_steps, rng=rng)
+    samples = chain[n_burn::thin].reshape(-1, 4)
+    samples[:, 3] = np.mod(samples[:, 3], 2)
+    return i, status, samples, log_probs[n_burn::thin].reshape(-1), acceptance, time.time() - start
+
+
+def run_mcmc(lc, pis, locs, scales, n_walkers=32, n_steps=2000, n_burn=1000, thin=10, n_processes=64, seed=0, tol=None):
+    """Sample the posteriors of many events in parallel, one event per task.
+
+    Yields:
+        i, status, samples, log_probs, acceptance, runtime: see run_event.
+    """
+    tasks = ((i, lc[i], pis[i], locs[i], scales[i], n_walkers, n_steps, n_burn, thin, seed + i, tol) for i in range(len(lc)))
+    with Pool(processes=n_processes) as pool:
+        for result in pool.imap_unordered(run_event, tasks):
+            yield result
+
+
+if __name__ == '__main__':
+
+    # accuracy of the finite-source magnification, None for the default of VBBL, see compute_model_lc in opt.py
+    tol = None
+    n_walkers, n_steps, n_burn, thin = 32, 2000, 1000, 10
+
+    input_filename = sys.argv[1]
+    output_filename = sys.argv[2]
+    # the input of opt.py, i.e. the light curves 'lc' and the mixtures 'pis', 'locs' and 'scales'
+    input_file = np.load(input_filename)
+    lc = input_file['lc']
+    pis, locs, scales = input_file['pis'], input_file['locs'], input_file['scales']
+
+    size = len(lc)
+    n_samples = n_walkers * len(range(n_burn, n_steps, thin))
+    samples = np.zeros((size, n_samples, 4))
+    log_probs = np.zeros((size, n_samples))
+    acceptance = np.zeros((size, n_walkers))
+    runtime = np.zeros(size)
+    status = np.full(size, 'ok', dtype=object)
+    for i, status_i, samples_i, log_probs_i, acceptance_i, runtime_i in tqdm(run_mcmc(lc, pis, locs, scales, n_walkers, n_steps, n_burn, thin, tol=tol), total=size):
+        status[i], samples[i], log_probs[i], acceptance[i], runtime[i] = status_i, samples_i, log_probs_i, acceptance_i, runtime_i
+
+    print(f'mean acceptance fraction {acceptance.mean():.3f}, {runtime.mean():.1f} s per event')
+    for i in np.flatnonzero(status != 'ok'):
+        print(f'event {i} {status[i]}')
+    # pass samples[i] as the chain of plot_covariance in plot_triangle.py
+    np.savez(output_filename, samples=samples, log_probs=log_probs, acceptance=acceptance, runtime=runtime, status=status.astype(str))
@@ -1,16 +1,24 @@
-import sys
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import signal
+import hashlib
+from collections import OrderedDict
 import numpy as np
+import h5py
 import matplotlib.pyplot as plt
 import pandas
 import VBBinaryLensing
-from scipy.optimize import minimize, fmin
+from scipy.optimize import minimize, fmin, least_squares
 
-from multiprocessing import Pool
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
 import timeout_decorator
 
 from tqdm import tqdm
 import time
 
+from model.fluxes import get_fsfb
+
 class MinimizeStopper(object):
     def __init__(self, max_sec=60):
         self.max_sec = max_sec
@@ -21,34 +29,70 @@ class MinimizeStopper(object):
             raise TimeoutError()
 
 
-def get_fsfb(amp, flux, ferr):
-    sig2 = ferr**2
-    wght = flux/sig2
-    d = np.ones(2)
-    d[0] = np.sum(wght*amp)
-    d[1] = np.sum(wght)
-    b = np.zeros((2,2))
-    b[0,0] = np.sum(amp**2/sig2)
-    b[0,1] = np.sum(amp/sig2)
-    b[1,0] = b[0,1]
-    b[1,1] = np.sum(1./sig2)
-    c = np.linalg.inv(b)
-    fs = np.sum(c[0]*d)
-    fb = np.sum(c[1]*d)
-    fserr = np.sqrt(c[0,0])
-    fberr = np.sqrt(c[1,1])
-    fmod = fs*amp+fb
-    chi2 = np.sum((flux-fmod)**2/sig2)
-    return chi2,fs,fb,fserr,fberr
-
-def binary_magnification(s, q, xs, ys, rho, VBBL):
-    if s < 20 and q > 1e-8 and s > 0.01 and q < 1e3:
-        return VBBL.BinaryMag2(s, q, xs, ys, rho)
-    else:
-        u2 = xs**2 + ys**2
-        return (u2+2)/np.sqrt(u2*(u2+4))
+# resolution of the keys of MagnificationCache, only merges evaluations equal up to rounding errors
+CACHE_QUANTUM = 1e-10
+
+class MagnificationCache(object):
+    """LRU cache of the model light curves of one event, keyed by the fitting parameters rounded to `quantum`.
+
+    Parameters without (t0, te) are keyed as (..., 0, 1), so the second fit of opt_t starts from cached values.
+    The key also holds the tolerance of compute_model_lc, so curves of different accuracies are never mixed.
+    The default quantum only merges evaluations equal up to rounding errors, and leaves the optimization unchanged.
+    A coarser quantum merges nearby evaluations too, trading the accuracy of the fits for a higher hit rate.
+
+    Args:
+        maxsize (int, optional): maximum number of cached light curves. Defaults to 1024.
+        quantum (float, optional): resolution of the parameters in the keys. Defaults to CACHE_QUANTUM.
+    """
+    def __init__(self, maxsize=1024, quantum=None):
+        self.maxsize = maxsize
+        self.quantum = CACHE_QUANTUM if quantum is None else quantum
+        self.store = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, fitting_parameters, tol=None):
+        p = np.asarray(fitting_parameters, dtype=float)
+        if len(p) == 4:
+            p = np.concatenate((p, [0, 1]))
+        return tuple(np.round(p / self.quantum)) + (VBBL_TOL if tol is None else tol,)
+
+    def get(self, key):
+        magnifications = self.store.get(key)
+        if magnifications is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.store.move_to_end(key)
+        return magnifications
+
+    def put(self, key, magnifications):
+        self.store[key] = magnifications
+        if len(self.store) > self.maxsize:
+            self.store.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+# accuracy of the finite-source magnification of VBBL, its default
+VBBL_TOL = 1e-2
+
+def compute_model_lc(time_array, fitting_parameters, VBBL, cache=None, tol=None):
+    """Magnification of the model at time_array.
 
-def compute_model_lc(time_array, fitting_parameters, VBBL):
+    VBBL already picks the method per point: point source where its quadrupole test passes, i.e. away from the
+    caustics, and contour integration of the finite source elsewhere. `tol` is the absolute accuracy of the
+    contour integration, the larger the cheaper. Defaults to None, i.e. VBBL_TOL.
+    """
+    if cache is not None:
+        # the cache belongs to one event, i.e. one time_array
+        key = cache.key(fitting_parameters, tol)
+        magnifications = cache.get(key)
+        if magnifications is None:
+            magnifications = compute_model_lc(time_array, fitting_parameters, VBBL, tol=tol)
+            cache.put(key, magnifications)
+        return magnifications
     if len(fitting_parameters) == 6:
         u0, lgq, lgs, ad180, t0, te = fitting_parameters
         rho = 1e-3
@@ -57,24 +101,96 @@ def compute_model_lc(time_array, fitting_parameters, VBBL):
         t0, te, rho = 0, 1, 1e-3
     q, s = 10**lgq, 10**lgs
     alpha = ad180 * np.pi # convert to radian
+    if s < 20 and q > 1e-8 and s > 0.01 and q < 1e3:
+        # the whole trajectory in one native call
+        # VBBL's source trajectory is (-xs, -ys) of ours, i.e. alpha + pi
+        params = [np.log(s), np.log(q), u0, alpha + np.pi, np.log(rho), np.log(te), t0]
+        VBBL.Tol = VBBL_TOL if tol is None else tol
+        return np.array(VBBL.BinaryLightCurve(params, time_array)[0])
     tau = (time_array-t0)/te
     xs = tau*np.cos(alpha) - u0*np.sin(alpha)
     ys = tau*np.sin(alpha) + u0*np.cos(alpha)
-    magnifications = np.array([binary_magnification(s, q, xs[i], ys[i], rho, VBBL) for i in range(len(xs))])
-    return magnifications
+    u2 = xs**2 + ys**2
+    return (u2+2)/np.sqrt(u2*(u2+4))
+
+def magnification_report(time_array, parameters, tol, n_repeat=3):
+    """Compare the magnification of compute_model_lc with tolerance `tol` against the default one.
+
+    Args:
+        time_array (array): time stamps.
+        parameters (array): fitting parameters of the models, shape (n_models, 4) or (n_models, 6). NaN rows are skipped.
+        tol (float): tolerance to test.
+        n_repeat (int, optional): number of timing repeats. Defaults to 3.
+
+    Returns:
+        report (dict): 'speedup', and the 'max_error' and 'median_error' relative to the default magnification.
+    """
+    VBBL = get_vbbl()
+    parameters = [p for p in parameters if not np.isnan(p).any()]
+    magnifications, elapsed = {}, {}
+    for name, t in [('default', None), ('tol', tol)]:
+        start = time.time()
+        for _ in range(n_repeat):
+            magnifications[name] = np.array([compute_model_lc(time_array, p, VBBL, tol=t) for p in parameters])
+        elapsed[name] = time.time() - start
+    error = np.abs(magnifications['tol'] / magnifications['default'] - 1)
+    return {
+        'speedup': elapsed['default'] / elapsed['tol'],
+        'max_error': float(error.max()),
+        'median_error': float(np.median(error)),
+    }
+
+_VBBL = None
+
+def get_vbbl():
+    # one VBBinaryLensing instance per worker process
+    global _VBBL
+    if _VBBL is None:
+        _VBBL = VBBinaryLensing.VBBinaryLensing()
+    return _VBBL
+
+class ModelCurve(object):
+    """(time, mag) model light curve of a fit on a fine grid, only rendered the first time it is indexed."""
+    def __init__(self, fitting_parameters, fs, fb, tol=None, time_model=None):
+        self.fitting_parameters = fitting_parameters
+        self.fs = fs
+        self.fb = fb
+        self.tol = tol
+        self.time_model = np.arange(-2, 2, 0.001) if time_model is None else time_model
+        self._curve = None
+
+    def render(self):
+        if self._curve is None:
+            magnifications = compute_model_lc(self.time_model, self.fitting_parameters, get_vbbl(), tol=self.tol)
+            mag_model = 18 - 2.5*np.log10(magnifications*self.fs + self.fb)
+            self._curve = np.vstack((self.time_model, mag_model))
+        return self._curve
+
+    def __getitem__(self, index):
+        return self.render()[index]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.render(), dtype=dtype)
 
 # @timeout_decorator.timeout(60, use_signals=True)
-def perform_optimization(time, flux, ferr, para_initial, verbose=True):
-    VBBL = VBBinaryLensing.VBBinaryLensing()
+def perform_optimization(time, flux, ferr, para_initial, verbose=True, max_sec=60, cache=None, tol=None, full_output=False):
+    """Nelder-Mead fit of one seed.
+
+    Returns (para_best, chi2_min, model, warnflag), model being a ModelCurve. With full_output, also a dict
+    of the fluxes 'fs' and 'fb' and the numbers of iterations 'n_iter' and of chi2 evaluations 'n_fev'.
+    """
+    VBBL = get_vbbl()
+    if cache is None:
+        cache = MagnificationCache()
     
     def compute_chisq(fitting_parameters, time, flux, ferr, VBBL, return_model=False):
-        magnifications = compute_model_lc(time, fitting_parameters, VBBL)
+        magnifications = compute_model_lc(time, fitting_parameters, VBBL, cache=cache, tol=tol)
         chi2, fs, fb, fserr, fberr = get_fsfb(magnifications, flux, ferr)
         if return_model:
             return chi2, fs, fb
         return chi2
 
-    para_best, chi2_min, iter, funcalls, warnflag, allvecs = fmin(compute_chisq, para_initial, args=(time, flux, ferr, VBBL), full_output=True, retall=True, maxiter=1000, maxfun=1000, disp=verbose, callback=MinimizeStopper(max_sec=60))
+    para_best, chi2_min, iter, funcalls, warnflag, allvecs = fmin(compute_chisq, para_initial, args=(time, flux, ferr, VBBL), full_output=True, retall=True, maxiter=1000, maxfun=1000, disp=verbose, callback=MinimizeStopper(max_sec=max_sec))
 
     chi2_min, fs, fb = compute_chisq(para_initial, time, flux, ferr, VBBL, return_model=True)
     if verbose:
@@ -82,33 +198,123 @@ def perform_optimization(time, flux, ferr, para_initial, verbose=True):
     chi2_min, fs, fb = compute_chisq(para_best, time, flux, ferr, VBBL, return_model=True)
     if verbose:
         print('best chisq & (fs, fb): ', chi2_min, fs, fb)
-    time_model = np.arange(-2, 2, 0.001)
-#    magnifications = compute_model_lc(time_model, para_initial, VBBL)
-    magnifications = compute_model_lc(time_model, para_best, VBBL)
-    mag_model = 18 - 2.5*np.log10(magnifications*fs + fb)
-    model = np.vstack((time_model, mag_model))
+        print(f'magnification cache: {cache.hits} hits, {cache.misses} misses')
+    model = ModelCurve(para_best, fs, fb, tol=tol)
+    if full_output:
+        return para_best, chi2_min, model, warnflag, {'fs': fs, 'fb': fb, 'n_iter': iter, 'n_fev': funcalls}
     return para_best, chi2_min, model, warnflag
 
-def get_best_params(lc, locs, n_gau, verbose=False, message=None, opt_t=False):
+def lm_residuals(fitting_parameters, time, flux, ferr, VBBL, cache=None):
+    # fs and fb are profiled out, so the residuals only depend on the nonlinear parameters
+    amp = compute_model_lc(time, fitting_parameters, VBBL, cache=cache)
+    _, fs, fb, _, _ = get_fsfb(amp, flux, ferr)
+    if not np.isfinite(fs):
+        raise ValueError(f'fs and fb are undetermined at {fitting_parameters}')
+    return (flux - fs*amp - fb) / ferr
+
+def lm_jacobian(fitting_parameters, time, flux, ferr, VBBL, cache=None, step=1e-4):
+    # central differences: VBBL computes the 2n perturbed light curves one by one, their fluxes are then solved
+    # in one vectorized get_fsfb; the cache spares the curves LM asks for again, e.g. after a rejected step
+    n = len(fitting_parameters)
+    perturbed = fitting_parameters + step * np.concatenate([np.eye(n), -np.eye(n)])
+    amp = np.array([compute_model_lc(time, p, VBBL, cache=cache) for p in perturbed])
+    _, fs, fb, _, _ = get_fsfb(amp, flux, ferr)
+    if not np.isfinite(fs).all():
+        raise ValueError(f'fs and fb are undetermined around {fitting_parameters}')
+    r = (flux - fs[:, None]*amp - fb[:, None]) / ferr
+    return ((r[:n] - r[n:]) / (2 * step)).T
+
+def perform_lm(time, flux, ferr, para_initial, max_nfev=50, step=1e-4, verbose=True, full_output=False, cache=None):
+    """Levenberg-Marquardt fit of one seed with fs and fb profiled out.
+
+    Each iteration costs 2n + 1 light curves of VBBL for n parameters, less the ones found in `cache`.
+    Returns (para_best, chi2_min, cov, warnflag). With full_output, also a dict of the fluxes 'fs' and 'fb'
+    and the numbers of Jacobian evaluations 'n_iter' and of residual evaluations 'n_fev'.
+    """
+    VBBL = get_vbbl()
+    if cache is None:
+        cache = MagnificationCache()
+    result = least_squares(lm_residuals, para_initial, args=(time, flux, ferr, VBBL, cache), method='lm', max_nfev=max_nfev,
+                           jac=lambda p, *args: lm_jacobian(p, *args, step=step))
+    para_best = result.x
+    chi2_min = 2 * result.cost
+    # covariance of the parameters from the Gauss-Newton approximation of the Hessian
+    J = result.jac
+    try:
+        cov = np.linalg.inv(J.T @ J)
+    except np.linalg.LinAlgError:
+        cov = np.full((len(para_best), len(para_best)), np.nan)
+    # 0 converged, 1 maximum number of evaluations reached, as the warnflag of fmin
+    warnflag = 0 if result.status > 0 else 1
+    if verbose:
+        print('best chisq: ', chi2_min, 'nfev: ', result.nfev)
+        print(f'magnification cache: {cache.hits} hits, {cache.misses} misses')
+    if full_output:
+        _, fs, fb, _, _ = get_fsfb(compute_model_lc(time, para_best, VBBL, cache=cache), flux, ferr)
+        return para_best, chi2_min, cov, warnflag, {'fs': fs, 'fb': fb, 'n_iter': result.njev, 'n_fev': result.nfev}
+    return para_best, chi2_min, cov, warnflag
+
+def get_best_params_lm(lc, locs, n_gau, verbose=False, message=None, opt_t=False, max_nfev=50, quantum=None):
+    """Levenberg-Marquardt version of get_best_params.
+
+    Returns the same (size, n_gau, 6) or (size, n_gau, 8) array of (chi2, warnflag, parameters),
+    and the covariances of the parameters, shape (size, n_gau, 4, 4) or (size, n_gau, 6, 6).
+    """
+    size = len(lc)
+    n_params = 6 if opt_t else 4
+    best_parameters = np.zeros((size, n_gau, n_params + 2))
+    covariances = np.full((size, n_gau, n_params, n_params), np.nan)
+    for i in tqdm(range(size)):
+        lc_i = lc[i]
+        ind_unique = np.unique(lc_i[:, 0], return_index=True)[1]
+        lc_i = lc_i[ind_unique]
+        cache = MagnificationCache(quantum=quantum)
+        for index in range(n_gau):
+            para_initial = locs[i, index, :-1] # (u0, lgq, lgs, ad180)
+            if np.isnan(para_initial).any():
+                best_parameters[i, index] = np.nan
+                best_parameters[i, index, 0] = np.inf
+                continue
+            if opt_t:
+                para_initial = np.concatenate((para_initial, [0, 1])) # (u0, lgq, lgs, ad180, t0, te)
+            try:
+                para_best, chi2_min, cov, warnflag = perform_lm(lc_i[:, 0], lc_i[:, 2], lc_i[:, 3], para_initial, max_nfev=max_nfev, verbose=verbose, cache=cache)
+                covariances[i, index] = cov
+            except Exception:
+                para_best = np.ones(n_params) * np.nan
+                chi2_min = np.inf
+                warnflag = -1
+            best_parameters[i, index] = np.hstack((chi2_min, warnflag, para_best))
+    print(f'# {message} done!')
+    return best_parameters, covariances
+
+def get_best_params(lc, locs, n_gau, verbose=False, message=None, opt_t=False, tol=None, quantum=None):
     size = len(lc)
     if opt_t:
         best_parameters = np.zeros((size, n_gau, 8))
     else:
         best_parameters = np.zeros((size, n_gau, 6))
+    hits, misses = 0, 0
     for i in tqdm(range(size)):
         lc_i = lc[i]
         ind_unique = np.unique(lc_i[:, 0], return_index=True)[1] 
         lc_i = lc_i[ind_unique]
+        cache = MagnificationCache(quantum=quantum)
         for index in range(n_gau):
             para_initial = locs[i, index, :-1] # (u0, lgq, lgs, ad180)
+            if np.isnan(para_initial).any():
+                # unused slot of a reduced mixture, see reduce_mixture in model/utils.py
+                best_parameters[i, index] = np.nan
+                best_parameters[i, index, 0] = np.inf
+                continue
             if verbose:
                 print(para_initial)
             try:
                 # if not opt_t:
-                para_best, chi2_min, model, warnflag = perform_optimization(lc_i[:, 0], lc_i[:, 2], lc_i[:, 3], para_initial, verbose=verbose)
+                para_best, chi2_min, model, warnflag = perform_optimization(lc_i[:, 0], lc_i[:, 2], lc_i[:, 3], para_initial, verbose=verbose, cache=cache, tol=tol)
                 if opt_t:
                     para_best = np.concatenate((para_best, [0, 1])) # (u0, lgq, lgs, ad180, t0, te)
-                    para_best, chi2_min, model, warnflag = perform_optimization(lc_i[:, 0], lc_i[:, 2], lc_i[:, 3], para_best, verbose=verbose)
+                    para_best, chi2_min, model, warnflag = perform_optimization(lc_i[:, 0], lc_i[:, 2], lc_i[:, 3], para_best, verbose=verbose, cache=cache, tol=tol)
             except:
                 print('timeout')
                 para_best = np.ones_like(para_initial) * np.nan
@@ -117,42 +323,423 @@ def get_best_params(lc, locs, n_gau, verbose=False, message=None, opt_t=False):
                 chi2_min = np.inf
                 warnflag = -1
             best_parameters[i, index] = np.hstack((chi2_min, warnflag, para_best))
-    print(f'# {message} done!')
+        hits, misses = hits + cache.hits, misses + cache.misses
+    print(f'# {message} done! magnification cache hit rate {hits / max(hits + misses, 1):.1%}')
     return best_parameters
 
+def perform_successive_halving(time, flux, ferr, seeds, round_fun=50, eta=2, max_fun=1000, verbose=True, tol=None, full_output=False, quantum=None):
+    """Fit all seeds of an event by successive halving instead of a full Nelder-Mead run each.
+
+    The seeds are advanced in rounds. After each round only the best 1/eta of the unconverged seeds by chi2
+    go on, and each survivor gets eta times the evaluations of the previous round, so every round costs
+    about the same. Each seed resumes from its last simplex, and no seed exceeds `max_fun` evaluations
+    in total, as with perform_optimization. Only the evaluations that compute a light curve count against
+    the budget, not the ones answered by the cache, e.g. the vertices of a resumed simplex. Seeds are ranked in the given order on ties, i.e. by pi
+    when they come from prepare_lc_mdn.
+
+    Args:
+        seeds (array): initial parameters of the seeds, shape (n_seeds, n_params). NaN rows are skipped.
+        round_fun (int, optional): evaluations per seed in the first round. Defaults to 50.
+        eta (int, optional): reduction factor of each round. Defaults to 2.
+        max_fun (int, optional): maximum evaluations per seed. Defaults to 1000.
+        tol (float, optional): accuracy of the finite-source magnification, see compute_model_lc. Defaults to None.
+        full_output (bool, optional): whether to also return the magnification cache 'hits' and 'misses' of each seed. Defaults to False.
+        quantum (float, optional): resolution of the magnification cache, see MagnificationCache. Defaults to None.
+
+    Returns:
+        rows (array): (chi2, warnflag, parameters) of each seed as in get_best_params, shape (n_seeds, n_params + 2).
+            The warnflag is 0 if converged, 1 if the budget was used up and 3 if dropped, with the parameters reached so far.
+        nfev (array): number of chi2 evaluations of each seed that computed a light curve, shape (n_seeds,).
+        counts (dict, if full_output==True): cache 'hits' and 'misses' of each seed, shape (n_seeds,).
+    """
+    VBBL = get_vbbl()
+    cache = MagnificationCache(quantum=quantum)
+    n_seeds, n_params = seeds.shape
+    hits, misses = np.zeros(n_seeds, dtype=int), np.zeros(n_seeds, dtype=int)
+    # the budget is spent on computed light curves only
+    nfev = misses
+
+    def compute_chisq(fitting_parameters, k):
+        # restarting from the last simplex re-evaluates its vertices, which the cache makes free
+        hits_before = cache.hits
+        magnifications = compute_model_lc(time, fitting_parameters, VBBL, cache=cache, tol=tol)
+        if cache.hits > hits_before:
+            hits[k] += 1
+        else:
+            misses[k] += 1
+        return get_fsfb(magnifications, flux, ferr)[0]
+
+    rows = np.full((n_seeds, n_params + 2), np.nan)
+    rows[:, 0] = np.inf
+    simplex = [None] * n_seeds
+    active = [k for k in range(n_seeds) if not np.isnan(seeds[k]).any()]
+    rows[active, 2:] = seeds[active]
+    n_fun = round_fun
+    while active:
+        for k in active:
+            # Nelder-Mead with the default tolerances of fmin, resumed from the last simplex
+            budget = min(n_fun, max_fun - nfev[k])
+            # maxfev counts every call, including the cached vertices of the resumed simplex
+            maxfev = budget if simplex[k] is None else budget + n_params + 1
+            result = minimize(compute_chisq, rows[k, 2:], args=(k,), method='Nelder-Mead',
+                              options={'maxfev': maxfev, 'xatol': 1e-4, 'fatol': 1e-4, 'initial_simplex': simplex[k]})
+            simplex[k] = result.final_simplex[0]
+            rows[k, 0], rows[k, 2:] = result.fun, result.x
+            rows[k, 1] = 0 if result.status == 0 else 1
+        active = [k for k in active if rows[k, 1] != 0 and nfev[k] < max_fun]
+        # stable sort, the heavier seed wins a tie
+        ranked = sorted(active, key=lambda k: rows[k, 0])
+        n_keep = int(np.ceil(len(ranked) / eta))
+        for k in ranked[n_keep:]:
+            rows[k, 1] = 3
+        active = sorted(ranked[:n_keep])
+        n_fun *= eta
+    if verbose:
+        print(f'best chisq: {rows[:, 0].min()}, {nfev.sum()} light curves computed for {np.sum(~np.isnan(seeds).any(axis=1))} seeds, '
+              f'{hits.sum()} evaluations answered by the cache')
+    if full_output:
+        return rows, nfev, {'hits': hits, 'misses': misses}
+    return rows, nfev
+
+def get_best_params_halving(lc, locs, n_gau, verbose=False, message=None, opt_t=False, round_fun=50, eta=2, quantum=None):
+    """Successive-halving version of get_best_params.
+
+    Returns the same (size, n_gau, 6) or (size, n_gau, 8) array of (chi2, warnflag, parameters), where dropped
+    seeds have warnflag 3, and the number of light curves computed for each seed, shape (size, n_gau).
+    """
+    size = len(lc)
+    n_params = 6 if opt_t else 4
+    best_parameters = np.zeros((size, n_gau, n_params + 2))
+    nfev = np.zeros((size, n_gau), dtype=int)
+    for i in tqdm(range(size)):
+        lc_i = lc[i]
+        ind_unique = np.unique(lc_i[:, 0], return_index=True)[1]
+        lc_i = lc_i[ind_unique]
+        seeds = locs[i, :n_gau, :-1] # (u0, lgq, lgs, ad180)
+        if opt_t:
+            seeds = np.concatenate((seeds, np.tile([0, 1], (n_gau, 1))), axis=1) # (u0, lgq, lgs, ad180, t0, te)
+        best_parameters[i], nfev[i] = perform_successive_halving(lc_i[:, 0], lc_i[:, 2], lc_i[:, 3], seeds, round_fun=round_fun, eta=eta, verbose=verbose, quantum=quantum)
+    n_seeds = np.sum(~np.isnan(locs[:, :n_gau, :-1]).any(axis=-1))
+    print(f'# {message} done! {nfev.sum()} light curves computed, {nfev.sum() / (1000 * n_seeds):.1%} of the maximum budget of full fits')
+    return best_parameters, nfev
+
+
+class TaskTimeout(Exception):
+    pass
+
+def _raise_timeout(signum, frame):
+    raise TaskTimeout()
+
+def run_task(task):
+    """Fit one (event, seed) pair under a wall-clock limit.
+
+    Returns (i, index, status, row, cov, info), with status 'ok', 'timeout' or 'failed: <error>', row the
+    (chi2, warnflag, parameters) of get_best_params, warnflag being -2 for a timeout and -1 for a failure,
+    cov the covariance of the parameters with use_lm, else None, and info a dict of the fluxes 'fs' and 'fb',
+    the wall-clock 'runtime', the number of iterations 'n_iter' and the magnification cache 'hits' and 'misses'.
+    With halving, index is None and the task fits all seeds of the event with perform_successive_halving,
+    row has one row per seed, cov is None, and n_iter, hits and misses are counted per seed.
+    """
+    i, index, lc_i, para_initial, opt_t, use_lm, timeout, halving, tol, quantum = task
+    start = time.time()
+    cov = None
+    cache = MagnificationCache(quantum=quantum)
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        if halving:
+            if opt_t:
+                para_initial = np.concatenate((para_initial, np.tile([0, 1], (len(para_initial), 1))), axis=1)
+            row, nfev, counts = perform_successive_halving(lc_i[:, 0], lc_i[:, 2], lc_i[:, 3], para_initial, verbose=False, tol=tol, full_output=True, quantum=quantum)
+            # fluxes of the final parameters of all seeds at once
+            fitted = np.isfinite(row[:, 0])
+            fs, fb = np.full(len(row), np.nan), np.full(len(row), np.nan)
+            if fitted.any():
+                amp = np.array([compute_model_lc(lc_i[:, 0], p, get_vbbl(), tol=tol) for p in row[fitted, 2:]])
+                _, fs[fitted], fb[fitted], _, _ = get_fsfb(amp, lc_i[:, 2], lc_i[:, 3])
+            info = {'fs': fs, 'fb': fb, 'n_iter': nfev, **counts}
+        elif use_lm:
+            if opt_t:
+                para_initial = np.concatenate((para_initial, [0, 1]))
+            para_best, chi2_min, cov, warnflag, info = perform_lm(lc_i[:, 0], lc_i[:, 2], lc_i[:, 3], para_initial, verbose=False, full_output=True, cache=cache)
+        else:
+            # the limit is enforced by the alarm, not by MinimizeStopper
+            para_best, chi2_min, _, warnflag, info = perform_optimization(lc_i[:, 0], lc_i[:, 2], lc_i[:, 3], para_initial, verbose=False, max_sec=np.inf, cache=cache, tol=tol, full_output=True)
+            if opt_t:
+                n_iter = info['n_iter']
+                para_best = np.concatenate((para_best, [0, 1])) # (u0, lgq, lgs, ad180, t0, te)
+                para_best, chi2_min, _, warnflag, info = perform_optimization(lc_i[:, 0], lc_i[:, 2], lc_i[:, 3], para_best, verbose=False, max_sec=np.inf, cache=cache, tol=tol, full_output=True)
+                info['n_iter'] += n_iter
+        status = 'ok'
+    except (TaskTimeout, TimeoutError):
+        status = 'timeout'
+    except Exception as e:
+        status = f'failed: {e!r}'
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    if status != 'ok':
+        return _failed_result(task, status, time.time() - start)
+    info = {'fs': info['fs'], 'fb': info['fb'], 'runtime': time.time() - start, 'n_iter': info['n_iter'],
+            'hits': info.get('hits', cache.hits), 'misses': info.get('misses', cache.misses)}
+    if halving:
+        return i, index, status, row, cov, info
+    return i, index, status, np.hstack((chi2_min, warnflag, para_best)), cov, info
+
+def _failed_result(task, status, runtime):
+    i, index, _, para_initial, opt_t, _, _, halving, _, _ = task
+    n_params = 6 if opt_t else 4
+    warnflag = -2 if status == 'timeout' else -1
+    row = np.hstack((np.inf, warnflag, np.full(n_params, np.nan)))
+    info = {'fs': np.nan, 'fb': np.nan, 'runtime': runtime, 'n_iter': 0, 'hits': 0, 'misses': 0}
+    if halving:
+        return i, index, status, np.tile(row, (len(para_initial), 1)), None, info
+    return i, index, status, row, None, info
+
+class ResultStore(object):
+    """Crash-safe store of the fit results of every (event, seed), in an HDF5 file written as the results arrive.
+
+    Each result is flushed to disk with its `done` flag, so a killed run only loses the tasks in flight, and a
+    re-run on the same file can skip the tasks already completed, see `completed`. Model curves are not stored,
+    see `model_curve`. A file is only resumed by a run with the same seeds and settings, e.g. `config`.
+
+    Args:
+        path (str): path of the HDF5 file, created if missing.
+        size (int): number of events.
+        n_gau (int): number of seeds per event.
+        n_params (int): number of fitted parameters, 4, or 6 with opt_t.
+        covariance (bool, optional): whether to store the covariances of the parameters of use_lm. Defaults to False.
+        locs (array, optional): seeds of the fits, stored as a hash. Defaults to None.
+        config (dict, optional): other settings the results depend on, e.g. tol, use_lm and halving. Defaults to None.
+    """
+    def __init__(self, path, size, n_gau, n_params, covariance=False, locs=None, config=None):
+        self.file = h5py.File(path, 'a')
+        attrs = {'size': size, 'n_gau': n_gau, 'n_params': n_params}
+        if locs is not None:
+            attrs['locs_hash'] = hashlib.sha256(np.ascontiguousarray(locs, dtype=float).tobytes()).hexdigest()
+        # repr, as None cannot be stored as an attribute
+        attrs.update({key: repr(value) for key, value in (config or {}).items()})
+        if 'done' in self.file:
+            for key, value in attrs.items():
+                if key not in self.file.attrs:
+                    raise ValueError(f'{path} holds results without {key}, cannot resume with {key}={value}')
+                if self.file.attrs[key] != value:
+                    raise ValueError(f'{path} holds results with {key}={self.file.attrs[key]}, not {value}')
+        else:
+            self.file.attrs.update(attrs)
+            self.file.create_dataset('done', shape=(size, n_gau), dtype=bool, chunks=True)
+            self.file.create_dataset('chi2', shape=(size, n_gau), dtype='f8', chunks=True, fillvalue=np.inf)
+            self.file.create_dataset('params', shape=(size, n_gau, n_params), dtype='f8', chunks=True, fillvalue=np.nan)
+            for name in ['warnflag', 'fs', 'fb', 'runtime', 'n_iter']:
+                self.file.create_dataset(name, shape=(size, n_gau), dtype='f8', chunks=True, fillvalue=np.nan)
+        for name in ['hits', 'misses']:
+            # magnification cache counts, missing from files of older runs
+            if name not in self.file:
+                self.file.create_dataset(name, shape=(size, n_gau), dtype='i8', chunks=True, fillvalue=0)
+        if covariance and 'cov' not in self.file:
+            self.file.create_dataset('cov', shape=(size, n_gau, n_params, n_params), dtype='f8', chunks=True, fillvalue=np.nan)
+        self.file.flush()
+
+    @property
+    def done(self):
+        return self.file['done'][...]
+
+    @property
+    def completed(self):
+        """Tasks done that did not time out or fail, i.e. all but a negative warnflag, which a re-run retries."""
+        return self.done & ~(self.file['warnflag'][...] < 0)
+
+    def write(self, i, index, row, info, cov=None):
+        """Store a result of run_task, index being None for all the seeds of an event."""
+        index = slice(None) if index is None else index
+        self.file['chi2'][i, index] = row[..., 0]
+        self.file['warnflag'][i, index] = row[..., 1]
+        self.file['params'][i, index] = row[..., 2:]
+        for name in ['fs', 'fb', 'runtime', 'n_iter', 'hits', 'misses']:
+            self.file[name][i, index] = info[name]
+        if cov is not None and 'cov' in self.file:
+            self.file['cov'][i, index] = cov
+        # the flag goes last, a result is only done once all of it is on disk
+        self.file['done'][i, index] = True
+        self.file.flush()
+
+    def best_parameters(self):
+        """(chi2, warnflag, parameters) of all tasks in the format of get_best_params, inf and NaN where not done."""
+        return np.concatenate([self.file['chi2'][...][..., None], self.file['warnflag'][...][..., None], self.file['params'][...]], axis=-1)
+
+    def model_curve(self, i, index, tol=None):
+        """ModelCurve of the fit of event i from seed index, rendered when it is first indexed."""
+        return ModelCurve(self.file['params'][i, index], self.file['fs'][i, index], self.file['fb'][i, index], tol=tol)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _task_worker(conn):
+    while True:
+        task = conn.recv()
+        if task is None:
+            return
+        conn.send(run_task(task))
+
+def _start_worker():
+    conn, child_conn = Pipe()
+    process = Process(target=_task_worker, args=(child_conn,), daemon=True)
+    process.start()
+    return conn, process
+
+
+def schedule(lc, locs, n_gau, n_processes=64, timeout=60, opt_t=False, use_lm=False, grace=5, halving=False, tol=None, skip=None, quantum=None):
+    """Run every (event, seed) fit as an independent task on worker processes, yielding the results as they finish.
+
+    Tasks are handed out one at a time to whichever worker is free, so a slow event only holds up its own worker.
+    They are submitted seed by seed, so the heaviest seed of every event is done first. NaN seeds (unused slots
+    of a reduced mixture) are skipped. A task is interrupted by an alarm after `timeout` seconds; if it is stuck
+    in native code and still running `grace` seconds later, its worker is killed and replaced.
+    With halving, a task is a whole event fitted by successive halving, with `timeout` seconds per seed.
+    `skip` is a boolean mask of shape (size, n_gau) of the tasks already done, e.g. ResultStore.completed.
+    `quantum` is the resolution of the magnification cache of each task, see MagnificationCache.
+
+    Yields:
+        i, index, status, row, cov, info: see run_task.
+    """
+    if halving and use_lm:
+        raise ValueError('halving runs Nelder-Mead rounds, it cannot be combined with use_lm')
+    if skip is None:
+        skip = np.zeros((len(lc), n_gau), dtype=bool)
+
+    def tasks():
+        if halving:
+            for i in range(len(lc)):
+                if skip[i].all():
+                    continue
+                seeds = locs[i, :n_gau, :-1] # (u0, lgq, lgs, ad180)
+                lc_i = lc[i][np.unique(lc[i][:, 0], return_index=True)[1]]
+                n_seeds = np.sum(~np.isnan(seeds).any(axis=-1))
+                yield i, None, lc_i, seeds, opt_t, use_lm, timeout * max(n_seeds, 1), halving, tol, quantum
+            return
+        for index in range(n_gau):
+            for i in range(len(lc)):
+                para_initial = locs[i, index, :-1] # (u0, lgq, lgs, ad180)
+                if np.isnan(para_initial).any() or skip[i, index]:
+                    continue
+                lc_i = lc[i][np.unique(lc[i][:, 0], return_index=True)[1]]
+                yield i, index, lc_i, para_initial, opt_t, use_lm, timeout, halving, tol, quantum
+
+    pending = tasks()
+    idle = [_start_worker() for _ in range(n_processes)]
+    busy = {} # conn -> (process, task, start time)
+    try:
+        while True:
+            while idle:
+                task = next(pending, None)
+                if task is None:
+                    break
+                conn, process = idle.pop()
+                conn.send(task)
+                busy[conn] = (process, task, time.time())
+            if not busy:
+                return
+            for conn in wait(list(busy), timeout=1):
+                process, task, start = busy.pop(conn)
+                try:
+                    result = conn.recv()
+                except EOFError:
+                    # the worker died, e.g. a crash in VBBL
+                    conn.close()
+                    process.join()
+                    result = _failed_result(task, f'failed: worker exited with code {process.exitcode}', time.time() - start)
+                    conn, process = _start_worker()
+                idle.append((conn, process))
+                yield result
+            now = time.time()
+            for conn, (process, task, start) in list(busy.items()):
+                # the limit of the task itself, which is longer for a whole event with halving
+                if now - start > task[6] + grace:
+                    process.kill()
+                    process.join()
+                    conn.close()
+                    del busy[conn]
+                    idle.append(_start_worker())
+                    yield _failed_result(task, 'timeout', now - start)
+    finally:
+        for conn, process in idle:
+            conn.send(None)
+        for process, _, _ in busy.values():
+            process.kill()
 
 if __name__ == '__main__':
 
     opt_t = False
+    # Levenberg-Marquardt instead of Nelder-Mead, also saves the covariances of the parameters
+    use_lm = False
+    # successive halving across the seeds of each event instead of a full fit of every seed
+    halving = False
+    # accuracy of the finite-source magnification, None for the default of VBBL, see compute_model_lc
+    tol = None
+    # resolution of the magnification cache, None for CACHE_QUANTUM; coarser ones raise the hit rate at the expense of accuracy
+    quantum = None
+    if halving and use_lm:
+        raise ValueError('halving runs Nelder-Mead rounds, it cannot be combined with use_lm')
 
     input_filename = sys.argv[1]
     output_filename = sys.argv[2]
     input_file = np.load(input_filename)
     lc = input_file['lc']
     locs = input_file['locs']
+    if len(sys.argv) > 3:
+        # merge nearly identical components first, which needs the weights and scales of the mixtures
+        import torch
+        from model.utils import reduce_mixture
+        _, locs, _, n_seeds = reduce_mixture(torch.tensor(input_file['pis']), torch.tensor(locs), torch.tensor(input_file['scales']), threshold=float(sys.argv[3]))
+        locs = locs.numpy()
+        print(f'{n_seeds.float().mean().item():.2f} seeds per light curve after merging')
 
     verbose = False
 
     n_gau = 12
-    size = 4096 * 4
-    if opt_t:
-        best_parameters = np.zeros((size, n_gau, 8))
-    else:
-        best_parameters = np.zeros((size, n_gau, 6))
-    
+    size = len(lc)
+    n_params = 6 if opt_t else 4
+    # results are stored as they arrive, a re-run with the same output skips the tasks already completed
+    # and retries the ones that timed out or failed
+    store = ResultStore(output_filename.replace('.npy', '') + '.h5', size, n_gau, n_params, covariance=use_lm,
+                        locs=locs[:, :n_gau], config={'tol': tol, 'quantum': quantum, 'use_lm': use_lm, 'halving': halving})
+    done = store.completed
 
     n_processes = 64
-    step = size // n_processes
-    pool = Pool(processes=n_processes)
-    results = []
-
-    for i in tqdm(range(n_processes)):
-        results.append(pool.apply_async(get_best_params, args=(lc[i*step:(i+1)*step], locs[i*step:(i+1)*step], n_gau, verbose, f'{i*step}:{(i+1)*step}', opt_t)))
+    if tol is not None:
+        report = magnification_report(lc[0][:, 0], locs[0, :n_gau, :-1], tol)
+        print(f"tol {tol}: {report['speedup']:.2f}x faster magnifications on the first event, max relative error {report['max_error']:.2g}")
+    seeds = ~np.isnan(locs[:, :n_gau, :-1]).any(axis=-1)
+    n_seeds = int(np.sum(seeds))
+    n_tasks = int(np.sum(~done.all(axis=-1))) if halving else int(np.sum(seeds & ~done))
+    print(f'{int(done.sum())} tasks already completed, {int(np.sum(store.done & ~done))} to retry')
+    counts = {'ok': 0, 'timeout': 0, 'failed': 0}
+    failures = []
+    hits, misses = 0, 0
+    for i, index, status, row, cov, info in tqdm(schedule(lc, locs, n_gau, n_processes, timeout=60, opt_t=opt_t, use_lm=use_lm, halving=halving, tol=tol, skip=done, quantum=quantum), total=n_tasks):
+        store.write(i, index, row, info, cov)
+        hits, misses = hits + np.sum(info['hits']), misses + np.sum(info['misses'])
+        if status.startswith('failed'):
+            counts['failed'] += 1
+            failures.append((i, index, status))
+        else:
+            counts[status] += 1
 
-    pool.close()
-    pool.join()
-
-    for i, result in enumerate(results):
-        best_parameters[i*step:(i+1)*step] = result.get()
-    
-    np.save(output_filename, best_parameters)
\ No newline at end of file
+    print(f"{counts['ok']} tasks done, {counts['timeout']} timed out, {counts['failed']} failed")
+    print(f'magnification cache: {hits} hits, {misses} misses, hit rate {hits / max(hits + misses, 1):.1%}')
+    for i, index, status in failures:
+        print(f'event {i} seed {index} {status}')
+    best_parameters = store.best_parameters()
+    if halving:
+        nfev = np.nansum(store.file['n_iter'][...])
+        print(f'{nfev:.0f} light curves computed, {nfev / (1000 * n_seeds):.1%} of the maximum budget of full fits, '
+              f'{np.sum(best_parameters[..., 1] == 3)} seeds dropped')
+    np.save(output_filename, best_parameters)
+    if use_lm:
+        np.save(output_filename.replace('.npy', '') + '_cov.npy', store.file['cov'][...])
+    store.close()
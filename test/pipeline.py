@@ -0,0 +1,287 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import glob
+import time
+import queue
+import argparse
+import threading
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+import torchcde
+
+from model.locator import load_locator
+from model.cde_mdn import load_estimator
+from model.utils import reduce_mixture
+from model.preprocess import pad_lcs, locator_interval, rescale_lcs, logsig_windows_batched, trim_to_bucket
+
+parser = argparse.ArgumentParser('MAGIC pipeline')
+parser.add_argument('input', type=str, help="Directory of light curves (.csv, .txt, .dat or .npy), one event per file")
+parser.add_argument('output', type=str, help="Path of the output .npz file")
+parser.add_argument('--locator', type=str, default='/work/hmzhao/experiments/locator/experiment_54125.ckpt', help="Path of the locator checkpoint")
+parser.add_argument('--estimator', type=str, default='/work/hmzhao/experiments/cde_mdn/experiment_l32nG12diag.ckpt', help="Path of the estimator checkpoint")
+parser.add_argument('-k', type=float, default=1/3, help="k of the locator")
+parser.add_argument('--method', type=str, default='diff', help="Method of the locator, diff or avg")
+parser.add_argument('--full-cov', action='store_true', help="Whether the estimator uses full covariance")
+parser.add_argument('--columns', type=str, default='HJD,mag_aligned,e_mag_aligned', help="Names of the time, magnitude and magnitude error columns of files with a header")
+parser.add_argument('-b', '--batch-size', type=int, default=256)
+parser.add_argument('--locate-batch-size', type=int, default=32, help="Number of light curves passed through the locator U-Net at once")
+parser.add_argument('--n-refine', type=int, default=12, help="Number of mixture components (by weight) refined by the optimizer, 0 to skip refinement")
+parser.add_argument('--merge-threshold', type=float, default=None, help="Merge mixture components closer than this squared distance before refinement, see reduce_mixture")
+parser.add_argument('--min-weight', type=float, default=1e-2, help="Drop mixture components lighter than this before refinement, with --merge-threshold")
+parser.add_argument('--refine-workers', type=int, default=64, help="Number of processes of the refinement stage")
+parser.add_argument('--logsig-workers', type=int, default=1, help="Number of processes computing the logsignatures")
+parser.add_argument('--queue-size', type=int, default=2, help="Number of batches buffered between two stages")
+parser.add_argument('--device', type=str, default='cpu')
+
+
+def load_lc(path, columns):
+    """Read one light curve as (t, mag, mag_err), sorted by time with duplicate time stamps removed."""
+    if path.endswith('.npy'):
+        lc = np.load(path)[:, :3]
+    else:
+        delimiter = ',' if path.endswith('.csv') else None
+        with open(path) as f:
+            first = f.readline().replace(',', ' ').split()
+        try:
+            [float(x) for x in first]
+            lc = np.loadtxt(path, delimiter=delimiter, ndmin=2)[:, :3]
+        except ValueError:
+            data = np.genfromtxt(path, delimiter=delimiter, names=True, dtype=None, encoding=None)
+            lc = np.stack([data[c] for c in columns], axis=-1).astype(float)
+    if lc.shape[1] == 2:
+        lc = np.hstack([lc, np.full((len(lc), 1), np.nan)])
+    lc = lc[np.isfinite(lc[:, :2]).all(axis=-1)]
+    lc = lc[np.unique(lc[:, 0], return_index=True)[1]]
+    return lc.astype(np.float32)
+
+
+class Stage(threading.Thread):
+    '''
+    Worker thread applying one step of the pipeline to each batch it receives.
+
+    Batches are passed between stages in memory through bounded queues, so all stages work on
+    different batches at the same time. A stage that fails on a batch marks its events as failed
+    and passes it on. None marks the end of the stream.
+    '''
+    def __init__(self, name, func, inbox, outbox):
+        super(Stage, self).__init__(name=name, daemon=True)
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.busy = 0.
+
+    def run(self):
+        while True:
+            batch = self.inbox.get()
+            if batch is None:
+                self.outbox.put(None)
+                return
+            start = time.time()
+            if 'error' not in batch:
+                try:
+                    batch = self.func(batch)
+                except Exception as e:
+                    batch['error'] = f'{self.name}: {e!r}'
+            self.busy += time.time() - start
+            self.outbox.put(batch)
+
+
+class Pipeline(object):
+    '''
+    Locate, rescale, compute the logsignature, estimate and refine batches of raw light curves.
+
+    Args:
+            locator (Locator): the locator.
+            estimator (CDE_MDN): the estimator.
+            device (str, optional): torch device of the estimator. Defaults to 'cpu'.
+            full_cov (bool, optional): whether the estimator uses full covariance. Defaults to False.
+            n_refine (int, optional): number of mixture components refined by `get_best_params` of `opt.py`, 0 to skip refinement. Defaults to 12.
+            refine_pool (multiprocessing.Pool, optional): processes of the refinement stage. Defaults to None.
+            logsig_workers (int, optional): number of processes computing the logsignatures. Defaults to 1.
+            merge_threshold (float, optional): if given, the mixtures are reduced by `reduce_mixture` with this threshold and only the distinct components are refined. Defaults to None.
+            min_weight (float, optional): minimum weight of the components kept by `reduce_mixture`. Defaults to 1e-2.
+            locate_batch_size (int, optional): number of light curves passed through the locator at once, to bound its memory. Defaults to 32.
+    '''
+    def __init__(self, locator, estimator, device='cpu', full_cov=False, n_refine=12, refine_pool=None, logsig_workers=1, merge_threshold=None, min_weight=1e-2, locate_batch_size=32):
+        self.locator = locator
+        self.estimator = estimator
+        self.device = device
+        self.full_cov = full_cov
+        self.n_refine = n_refine
+        self.refine_pool = refine_pool
+        self.logsig_workers = logsig_workers
+        self.merge_threshold = merge_threshold
+        self.min_weight = min_weight
+        self.locate_batch_size = locate_batch_size
+        if n_refine > 0:
+            # opt.py needs VBBinaryLensing, only import it when refining
+            from opt import get_best_params
+            self.get_best_params = get_best_params
+
+    def locate(self, batch):
+        X, lengths = pad_lcs([torch.as_tensor(lc[:, :2]) for lc in batch['lcs']])
+        coeffs = torchcde.hermite_cubic_coefficients_with_backward_differences(X)
+        interval = locator_interval(lengths, self.locator.n_intervals)
+        batch['reg'] = self.locator.predict(coeffs, interval=interval, batch_size=self.locate_batch_size).cpu()
+        batch['X'], batch['lengths'] = X, lengths
+        return batch
+
+    def logsig(self, batch):
+        batch['X'] = rescale_lcs(batch['X'], batch['reg'], batch['lengths'])
+        batch['logsig'], batch['logsig_lengths'], failures = logsig_windows_batched(batch['X'], lengths=batch['lengths'], n_workers=self.logsig_workers)
+        batch['failures'] = dict(batch['read_failures'])
+        batch['failures'].update({failure['index']: failure['reason'] for failure in failures if failure['index'] not in batch['failures']})
+        batch['logsig_lengths'][list(batch['failures'])] = 0
+        return batch
+
+    def estimate(self, batch):
+        n, n_gaussian, output_dim = len(batch['lcs']), self.estimator.n_gaussian, self.estimator.output_dim
+        batch['pis'] = np.full((n, n_gaussian), np.nan, dtype=np.float32)
+        batch['locs'] = np.full((n, n_gaussian, output_dim), np.nan, dtype=np.float32)
+        scale_shape = (output_dim, output_dim) if self.full_cov else (output_dim,)
+        batch['scales'] = np.full((n, n_gaussian, *scale_shape), np.nan, dtype=np.float32)
+
+        lengths = batch['logsig_lengths']
+        ok = torch.where(lengths > 0)[0]
+        if len(ok) == 0:
+            return batch
+        coeffs = torchcde.hermite_cubic_coefficients_with_backward_differences(batch['logsig'][ok])
+        coeffs = trim_to_bucket(coeffs, lengths[ok])
+        with torch.no_grad():
+            pi, normal = self.estimator(coeffs.to(self.device), lengths=lengths[ok].to(self.device))
+        pis, locs = pi.probs.cpu(), normal.loc.cpu()
+        scales = normal.covariance_matrix.cpu() if self.full_cov else normal.scale.cpu()
+        if self.merge_threshold is not None:
+            pis, locs, scales, _ = reduce_mixture(pis, locs, scales, self.min_weight, self.merge_threshold)
+        else:
+            # components sorted by weight, as in `prepare_lc_mdn` of `loc+cdemdn.ipynb`
+            order = torch.argsort(pis, dim=-1, descending=True)
+            first_indices = torch.arange(len(ok))[:, None]
+            pis, locs, scales = pis[first_indices, order], locs[first_indices, order], scales[first_indices, order]
+        batch['pis'][ok.numpy()] = pis.numpy()
+        batch['locs'][ok.numpy()] = locs.numpy()
+        batch['scales'][ok.numpy()] = scales.numpy()
+        return batch
+
+    def refine(self, batch):
+        batch['refined'] = []
+        if self.n_refine == 0:
+            return batch
+        for i, length in enumerate(batch['lengths'].tolist()):
+            if i in batch['failures']:
+                batch['refined'].append(None)
+                continue
+            t, mag = batch['X'][i, :length, 0].numpy(), batch['X'][i, :length, 1].numpy()
+            merr = batch['lcs'][i][:, 2]
+            merr = np.where(np.isfinite(merr), merr, 0.033)
+            window = (t >= -2) * (t <= 2)
+            # flux with the baseline at magnitude 18, as in `prepare_lc_mdn`
+            mag = mag / 5 + 18
+            flux = 10 ** (0.4 * (18 - mag))
+            ferr = merr * flux * np.log(10) / 2.5
+            lc = np.stack([t, mag, flux, ferr], axis=-1)[window]
+            args = (lc[None], batch['locs'][[i], :self.n_refine], self.n_refine, False, batch['names'][i])
+            if self.refine_pool is None:
+                batch['refined'].append(self.get_best_params(*args))
+            else:
+                batch['refined'].append(self.refine_pool.apply_async(self.get_best_params, args=args))
+        return batch
+
+    def collect(self, batch):
+        best_parameters = np.full((len(batch['lcs']), self.n_refine, 6), np.nan)
+        for i, result in enumerate(batch['refined']):
+            if result is not None:
+                best_parameters[i] = result if isinstance(result, np.ndarray) else result.get()
+        batch['best_parameters'] = best_parameters
+        return batch
+
+    def run(self, batches, queue_size=2):
+        '''
+        Run all stages concurrently over an iterable of batches, each a dict with the keys 'names' and 'lcs'.
+
+        Yields:
+                batch (dict): the processed batches in order, with the keys 'reg', 'pis', 'locs', 'scales', 'best_parameters' and 'failures' added.
+        '''
+        steps = [('locate', self.locate), ('logsig', self.logsig), ('estimate', self.estimate),
+                 ('refine', self.refine), ('collect', self.collect)]
+        queues = [queue.Queue(maxsize=queue_size) for _ in range(len(steps) + 1)]
+        self.stages = [Stage(name, func, queues[i], queues[i+1]) for i, (name, func) in enumerate(steps)]
+        for stage in self.stages:
+            stage.start()
+
+        def feed():
+            for batch in batches:
+                queues[0].put(batch)
+            queues[0].put(None)
+        threading.Thread(target=feed, daemon=True).start()
+
+        while True:
+            batch = queues[-1].get()
+            if batch is None:
+                return
+            yield batch
+
+
+def read_batches(paths, batch_size, columns):
+    for i in range(0, len(paths), batch_size):
+        names, lcs, failures = [], [], {}
+        for path in paths[i:i+batch_size]:
+            try:
+                lc = load_lc(path, columns)
+                if len(lc) < 2:
+                    raise ValueError('fewer than 2 points')
+            except Exception as e:
+                failures[len(lcs)] = f'read: {e!r}'
+                lc = np.zeros((2, 3), dtype=np.float32)
+                lc[1, 0] = 1
+            names.append(os.path.splitext(os.path.basename(path))[0])
+            lcs.append(lc)
+        yield {'names': names, 'lcs': lcs, 'read_failures': failures}
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    columns = args.columns.split(',')
+    paths = sorted([path for ext in ['csv', 'txt', 'dat', 'npy'] for path in glob.glob(os.path.join(args.input, f'*.{ext}'))])
+    print(f'{len(paths)} light curves found in {args.input}')
+
+    print('loading locator')
+    locator = load_locator(args.locator, args.device, k=args.k, method=args.method)
+    print('loading estimator')
+    # (t, mag) paths with depth 3 logsignatures have 5 channels
+    estimator = load_estimator(args.estimator, 5, 5, args.device, full_cov=args.full_cov)
+    device = next(estimator.parameters()).device
+
+    refine_pool = Pool(processes=args.refine_workers) if args.n_refine > 0 and args.refine_workers > 1 else None
+    pipeline = Pipeline(locator, estimator, device, args.full_cov, args.n_refine, refine_pool, args.logsig_workers,
+                        args.merge_threshold, args.min_weight, args.locate_batch_size)
+
+    results = {key: [] for key in ['names', 'reg', 'pis', 'locs', 'scales', 'best_parameters']}
+    failures = {}
+    start = time.time()
+    for batch in pipeline.run(read_batches(paths, args.batch_size, columns), args.queue_size):
+        if 'error' in batch:
+            for name in batch['names']:
+                failures[name] = batch['error']
+            continue
+        for j, reason in batch['failures'].items():
+            failures[batch['names'][j]] = reason
+            batch['reg'][j] = np.nan
+        for key in results:
+            results[key].append(np.asarray(batch[key]))
+        print(f"{sum(len(names) for names in results['names'])}/{len(paths)} light curves done, {time.time() - start:.1f}s")
+
+    if refine_pool is not None:
+        refine_pool.close()
+        refine_pool.join()
+
+    for stage in pipeline.stages:
+        print(f'{stage.name:>8} busy {stage.busy:.1f}s')
+    for name, reason in failures.items():
+        print(f'failed {name}: {reason}')
+
+    results = {key: np.concatenate(value) if len(value) else np.zeros(0) for key, value in results.items()}
+    np.savez(args.output, failed_names=np.array(list(failures.keys()), dtype=str), **results)
+    print(f'results saved to {args.output}')
@@ -0,0 +1,95 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import argparse
+import h5py
+import torch
+import torchcde
+import matplotlib
+matplotlib.use('Agg')
+
+from model.cde_mdn import CDE_MDN, quantize_estimator, save_quantized_estimator
+from model.utils import inference, get_peak_pred, plot_params
+
+parser = argparse.ArgumentParser('Quantize CDE-MDN')
+parser.add_argument('--ckpt', type=str, default='/work/hmzhao/experiments/cde_mdn/experiment_l32nG12diag.ckpt', help="Path of the float checkpoint")
+parser.add_argument('--save', type=str, default='/work/hmzhao/experiments/cde_mdn/experiment_l32nG12diag-int8.ckpt', help="Path to save the quantized checkpoint")
+parser.add_argument('--dataset', type=str, default='/work/hmzhao/irregular-lc/KMT-fixrho-test.h5', help="Path for the test dataset")
+parser.add_argument('--size', type=int, default=4096, help="Number of light curves used for the report")
+parser.add_argument('-b', '--batch-size', type=int, default=256)
+parser.add_argument('--threads', type=int, default=None, help="Number of CPU threads")
+parser.add_argument('--full-cov', action='store_true', help="Whether the estimator uses full covariance")
+
+args = parser.parse_args()
+
+
+def get_nll(pis, locs, scales, Y, full_cov=False):
+    """Mean negative log likelihood of the ground truth under the predicted Gaussian mixture."""
+    if full_cov:
+        normal = torch.distributions.MultivariateNormal(locs, covariance_matrix=scales)
+        loglik = normal.log_prob(Y.unsqueeze(1).expand_as(locs))
+    else:
+        normal = torch.distributions.Normal(locs, scales)
+        loglik = torch.sum(normal.log_prob(Y.unsqueeze(1).expand_as(locs)), dim=2)
+    return -torch.logsumexp(torch.log(pis) + loglik, dim=1).mean().item()
+
+
+if __name__ == '__main__':
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    with h5py.File(args.dataset, mode='r') as dataset_file:
+        Y = torch.tensor(dataset_file['Y'][...])
+        X = torch.tensor(dataset_file['X'][...])
+
+    # filter nan
+    nanind = torch.where(~torch.isnan(X[:, 0, 1]))[0]
+    Y = Y[nanind][:args.size]
+    X = X[nanind][:args.size]
+
+    Y[:, 3:6] = torch.log10(Y[:, 3:6])
+    Y[:, -1] = torch.log10(Y[:, -1])
+    Y[:, 6] = Y[:, 6] / 180
+    Y = Y[:, [2, 4, 5, 6, 7]]
+
+    X[:, :, 1] = (X[:, :, 1] - 14.5 - 2.5 * Y[:, [-1]]) / 0.2
+    X = X[:, :, :2]
+
+    # CDE interpolation with log_sig
+    depth = 3; window_length = max(X.shape[1]//100, 1)
+    logsig = torchcde.logsig_windows(X, depth, window_length=window_length)
+    coeffs = torchcde.hermite_cubic_coefficients_with_backward_differences(logsig)
+    size = len(coeffs)
+
+    checkpt = torch.load(args.ckpt, map_location='cpu')
+    ckpt_args = checkpt['args']
+    state_dict = checkpt['state_dict']
+
+    model = CDE_MDN(logsig.shape[-1], ckpt_args.latents, Y.shape[-1], ckpt_args.ngaussians, full_cov=args.full_cov)
+    model_dict = model.state_dict()
+    # 1. filter out unnecessary keys
+    state_dict = {k: v for k, v in state_dict.items() if k in model_dict}
+    # 2. overwrite entries in the existing state dict
+    model_dict.update(state_dict)
+    # 3. load the new state dict
+    model.load_state_dict(model_dict)
+
+    model_q = quantize_estimator(model)
+    save_quantized_estimator(model_q, ckpt_args, args.save)
+    print(f'Quantized model saved to {args.save}')
+
+    report = {}
+    for name, estimator in [('float32', model), ('int8', model_q)]:
+        start = time.time()
+        pis, locs, scales = inference(estimator, size, args.batch_size, coeffs, 'cpu', full_cov=args.full_cov)
+        elapsed = time.time() - start
+        nll = get_nll(pis, locs, scales, Y, full_cov=args.full_cov)
+        pred = get_peak_pred(pis, locs, scales, Y, n_step=1000)
+        rmse = plot_params(size, Y, *pred, title=name, save=os.path.splitext(args.save)[0] + f'-{name}.png')
+        report[name] = {'nll': nll, 'rmse': rmse, 'throughput': size / elapsed, 'locs': locs}
+
+    print(f"{'':>8} {'NLL':>8} {'RMSE lgq':>9} {'RMSE lgs':>9} {'RMSE u0':>9} {'RMSE a':>9} {'RMSE lgfs':>9} {'lc/s':>8}")
+    for name, result in report.items():
+        print(f"{name:>8} {result['nll']:8.4f} " + ' '.join([f'{r:9.4f}' for r in result['rmse']]) + f" {result['throughput']:8.2f}")
+    print(f"speedup: {report['int8']['throughput'] / report['float32']['throughput']:.2f}x")
+    print(f"max |loc difference|: {torch.max(torch.abs(report['int8']['locs'] - report['float32']['locs'])).item():.4g}")
@@ -0,0 +1,87 @@
+import sys
+import json
+import time
+import socket
+import argparse
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+parser = argparse.ArgumentParser('MAGIC server load test')
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--socket', type=str, default=None, help="Path of the Unix socket of the server")
+parser.add_argument('--rps', type=float, default=50, help="Target requests per second")
+parser.add_argument('--duration', type=float, default=30, help="Duration (s) of the test")
+parser.add_argument('--concurrency', type=int, default=256, help="Maximum number of requests in flight")
+parser.add_argument('-r', '--random-seed', type=int, default=42, help="Random_seed")
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=60):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def simulate_single_lens(rng, n_points):
+    """A noisy single lens light curve (t, mag) with random t_0, t_E, u_0, f_s and cadence."""
+    t_0, t_E = rng.uniform(-50, 50), 10 ** rng.uniform(0.7, 2)
+    u_0, fs = rng.uniform(0, 1), 10 ** rng.uniform(-1, 0)
+    t = np.sort(rng.uniform(-150, 150, n_points))
+    u2 = ((t - t_0) / t_E) ** 2 + u_0 ** 2
+    amp = (u2 + 2) / np.sqrt(u2 * (u2 + 4))
+    mag = 18 - 2.5 * np.log10(fs * amp + 1 - fs) + 0.033 * rng.standard_normal(n_points)
+    return np.stack([t, mag], axis=-1)
+
+
+def request(args, method, path, body=None):
+    if args.socket is not None:
+        conn = UnixHTTPConnection(args.socket)
+    else:
+        conn = http.client.HTTPConnection(args.host, args.port, timeout=60)
+    try:
+        data = None if body is None else json.dumps(body)
+        conn.request(method, path, body=data, headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        conn.close()
+
+
+def send(args, lc, scheduled):
+    try:
+        status, _ = request(args, 'POST', '/predict', {'lc': lc.tolist()})
+    except Exception:
+        status = -1
+    return status, time.time() - scheduled
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.random_seed)
+    n_requests = int(args.rps * args.duration)
+    lcs = [simulate_single_lens(rng, int(10 ** rng.uniform(2, 3.5))) for _ in range(min(n_requests, 1000))]
+
+    futures = []
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for i in range(n_requests):
+            scheduled = start + i / args.rps
+            time.sleep(max(scheduled - time.time(), 0))
+            futures.append(executor.submit(send, args, lcs[i % len(lcs)], scheduled))
+        results = [future.result() for future in futures]
+    elapsed = time.time() - start
+
+    status = np.array([r[0] for r in results])
+    latency = np.array([r[1] for r in results])
+    print(f'sent {n_requests} requests in {elapsed:.1f}s: {n_requests / elapsed:.1f} req/s (target {args.rps})')
+    print(f'ok: {np.sum(status == 200)}, rejected: {np.sum((status >= 400) * (status < 500))}, failed: {np.sum((status < 0) + (status >= 500))}')
+    print('client latency (s): p50 %.3f, p95 %.3f, p99 %.3f' % tuple(np.percentile(latency, [50, 95, 99])))
+    print('server metrics:', json.dumps(request(args, 'GET', '/metrics')[1], indent=2))
+    sys.exit(0 if np.all(status == 200) else 1)